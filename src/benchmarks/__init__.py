@@ -0,0 +1 @@
+"""Synthetic-scene benchmarks for the pipeline stages; run with `python -m benchmarks` from src/."""
@@ -0,0 +1,165 @@
+"""
+Benchmark every pipeline stage on deterministic synthetic scenes.
+
+Run from src/:
+
+    python -m benchmarks --sizes 2048 8192 --save_baseline benchmarks/baseline.json
+    python -m benchmarks --sizes 2048 8192 --baseline benchmarks/baseline.json
+
+Each stage runs in a fresh process, so the reported peak RSS belongs to
+that stage alone (its inputs in memory plus its working set). Throughput is MPix/s of the stage's input (the search
+window for find_best_shift). With --baseline the run exits non-zero if
+any stage's throughput drops by more than --threshold, or if a stage's
+output no longer matches the scene's known shift and blob counts.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from rasterio.errors import NotGeoreferencedWarning
+
+import metrics
+from benchmarks.scenes import write_scene
+from benchmarks.stages import STAGES
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter to the current RSS (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    # VmHWM is per address space; ru_maxrss would include the parent's peak, which survives exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_stage(name, scene, work_dir, repeat, verbose):
+    setup, _ = STAGES[name]
+    os.makedirs(work_dir, exist_ok=True)
+    with contextlib.ExitStack() as quiet:
+        if not verbose:
+            quiet.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            quiet.enter_context(warnings.catch_warnings(action="ignore", category=NotGeoreferencedWarning))
+        run, pixels, check = setup(scene, work_dir)
+        _reset_peak_rss()  # peak covers the stage's inputs in memory plus the runs, not setup scratch
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            result = run()
+            times.append(time.perf_counter() - t0)
+        ok = bool(check(result))
+    best = min(times)
+    return {
+        "seconds": best,
+        "pixels": pixels,
+        "mpix_s": pixels / best / 1e6,
+        "peak_rss_mb": _peak_rss_mb(),
+        "ok": ok,
+    }
+
+
+def run_benchmarks(sizes, stages, work_dir, repeat=3, seed=0, verbose=False):
+    """Run each stage on each scene size in its own spawned process; returns {"stage@size": result}."""
+    results = {}
+    ctx = get_context("spawn")
+    for size in sizes:
+        t0 = time.perf_counter()
+        scene = write_scene(os.path.join(work_dir, f"scene-{size}"), size, seed=seed)
+        print(f"Scene {size}x{size}: {scene['blobs']} blobs, {scene['specks']} specks, shift {scene['shift']} "
+              f"({time.perf_counter() - t0:.1f}s)")
+
+        for name in stages:
+            max_size = STAGES[name][1]
+            if max_size is not None and size > max_size:
+                print(f"  {name:<22} skipped (> {max_size} px)")
+                continue
+            stage_dir = os.path.join(work_dir, f"run-{size}", name)
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                r = pool.submit(_run_stage, name, scene, stage_dir, repeat, verbose).result()
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            results[f"{name}@{size}"] = r
+            metrics.emit({"stage": name, "size": size, "wall_s": round(r["seconds"], 6), "pixels": r["pixels"],
+                          "mpix_s": round(r["mpix_s"], 3), "peak_rss_mb": round(r["peak_rss_mb"], 1), "ok": r["ok"]})
+            print(f"  {name:<22}{r['seconds']:>9.3f}s{r['mpix_s']:>10.1f} MPix/s{r['peak_rss_mb']:>9.0f} MB"
+                  f"{'' if r['ok'] else '  OUTPUT MISMATCH'}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the keys whose throughput fell more than threshold (fraction) below the baseline."""
+    regressions = []
+    for key, r in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        change = r["mpix_s"] / base["mpix_s"] - 1
+        mark = "REGRESSION" if change < -threshold else ""
+        print(f"  {key:<30}{base['mpix_s']:>9.1f} -> {r['mpix_s']:>7.1f} MPix/s ({change:+.1%})  "
+              f"RSS {base['peak_rss_mb']:.0f} -> {r['peak_rss_mb']:.0f} MB  {mark}")
+        if mark:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic scenes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2048], help="Scene sizes in pixels (default: 2048)")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES),
+                        help="Stages to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the best is kept (default=3)")
+    parser.add_argument("--seed", type=int, default=0, help="Scene generator seed (default=0)")
+    parser.add_argument("--work_dir", default=None, help="Scene and scratch directory, reused across runs "
+                                                         "(default: a temporary directory)")
+    parser.add_argument("--baseline", help="Baseline JSON to compare throughput against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed throughput drop vs the baseline, as a fraction (default=0.2)")
+    parser.add_argument("--save_baseline", help="Write this run's results as a baseline JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the stages' own output")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args, "benchmarks")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="ccd-bench-")
+    try:
+        results = run_benchmarks(args.sizes, args.stages, work_dir, args.repeat, args.seed, args.verbose)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    failed = [key for key, r in results.items() if not r["ok"]]
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"machine": platform.node(), "cpus": os.cpu_count(), "results": results}, f, indent=2)
+        print(f"✅ Baseline saved: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print(f"\nCompared with {args.baseline} (threshold -{args.threshold:.0%})")
+        failed += compare(results, baseline, args.threshold)
+
+    if failed:
+        print(f"❌ {len(failed)} failed: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,92 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+# Bump when the generator changes so cached scenes are rebuilt
+VERSION = 1
+
+CELL = 512  # change blobs are placed one per grid cell, so they never touch
+
+
+def _texture(rng, size):
+    """Smooth multi-scale uint8 texture, built at low resolution and upsampled to keep 20k scenes cheap."""
+    img = np.zeros((size, size), dtype=np.float32)
+    for scale, weight in ((64, 0.5), (16, 0.3), (4, 0.2)):
+        small = rng.random((size // scale + 2, size // scale + 2), dtype=np.float32)
+        img += weight * cv2.resize(small, (size, size), interpolation=cv2.INTER_CUBIC)
+    img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
+    return img.astype(np.uint8)
+
+
+def make_scene(size, shift=(3, -2), seed=0):
+    """
+    Generate a deterministic before/after/mask scene.
+
+    The after image is the before image rolled by shift = (dx, dy), so
+    image_reg_msecalc should find exactly that shift, plus bright change
+    blobs. Large blobs (>= 900 px, above the default area threshold) and
+    small specks (< 900 px) are placed in distinct cells of a CELL grid so
+    they never merge. The mask marks both, in the after image's frame.
+
+    Returns:
+        (before, after, mask, meta) with uint8 arrays and a dict of the
+        known shift and blob counts.
+    """
+    rng = np.random.default_rng(seed)
+    dx, dy = shift
+    before = _texture(rng, size)
+    after = np.roll(before, (dy, dx), axis=(0, 1))
+    mask = np.zeros_like(before)
+
+    cells = (size // CELL) ** 2
+    n_blobs = min(cells, max(8, cells // 8))
+    n_specks = min(cells - n_blobs, n_blobs // 2)
+    chosen = rng.choice(cells, n_blobs + n_specks, replace=False)
+
+    for k, cell in enumerate(chosen):
+        cy, cx = divmod(int(cell), size // CELL)
+        if k < n_blobs:
+            h, w = rng.integers(40, 200, size=2)
+        else:
+            h, w = rng.integers(3, 20, size=2)
+        y0 = cy * CELL + int(rng.integers(16, CELL - h - 16))
+        x0 = cx * CELL + int(rng.integers(16, CELL - w - 16))
+        mask[y0:y0 + h, x0:x0 + w] = 255
+        after[y0:y0 + h, x0:x0 + w] = 255
+
+    meta = {"version": VERSION, "size": size, "seed": seed, "shift": [dx, dy],
+            "blobs": n_blobs, "specks": n_specks}
+    return before, after, mask, meta
+
+
+def write_scene(out_dir, size, shift=(3, -2), seed=0):
+    """
+    Write a scene as before.png, after.png, mask.png and a georeferenced
+    reference.tif (UTM 43N, 0.65 m pixels), reusing an existing one with
+    the same parameters. Returns the scene metadata with file paths.
+    """
+    meta_path = os.path.join(out_dir, "scene.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta["version"], meta["size"], meta["seed"], meta["shift"]) == (VERSION, size, seed, list(shift)):
+            return meta
+
+    os.makedirs(out_dir, exist_ok=True)
+    before, after, mask, meta = make_scene(size, shift, seed)
+    for name, img in (("before", before), ("after", after), ("mask", mask)):
+        meta[name] = os.path.join(out_dir, f"{name}.png")
+        cv2.imwrite(meta[name], img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+
+    meta["reference"] = os.path.join(out_dir, "reference.tif")
+    with rasterio.open(meta["reference"], "w", driver="GTiff", count=1, height=size, width=size, dtype="uint8",
+                       crs="EPSG:32643", transform=from_origin(500000, 2000000, 0.65, 0.65), tiled=True) as dst:
+        dst.write(before, 1)
+
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return meta
@@ -0,0 +1,137 @@
+import os
+
+import cv2
+
+# Window and search radius for find_best_shift; the scene shift must lie inside the radius
+SHIFT_WINDOW = 1024
+SHIFT_RANGE = 4
+TILE = 256
+AREA_THRESHOLD = 900
+
+
+def bench_find_best_shift(scene, work_dir):
+    from image_reg_msecalc import find_best_shift
+
+    before = cv2.imread(scene["before"], cv2.IMREAD_GRAYSCALE)
+    after = cv2.imread(scene["after"], cv2.IMREAD_GRAYSCALE)
+    wsize = min(SHIFT_WINDOW, scene["size"] // 2)
+    start = (scene["size"] - wsize) // 2
+
+    def run():
+        return find_best_shift(before, after, start, start, wsize, SHIFT_RANGE)
+
+    def check(result):
+        return list(result[0]) == scene["shift"]
+
+    return run, wsize * wsize, check
+
+
+def bench_filter_polygons_cv2(scene, work_dir):
+    from maskfilter import filter_polygons_cv2
+
+    mask = cv2.imread(scene["mask"], cv2.IMREAD_GRAYSCALE)
+
+    def run():
+        return filter_polygons_cv2(mask, AREA_THRESHOLD)
+
+    def check(result):
+        _, total, kept = result
+        return (total, kept) == (scene["blobs"] + scene["specks"], scene["blobs"])
+
+    return run, mask.size, check
+
+
+def bench_filter_components(scene, work_dir):
+    from maskfilter import filter_components
+
+    mask = cv2.imread(scene["mask"], cv2.IMREAD_GRAYSCALE)
+
+    def run():
+        return filter_components(mask, AREA_THRESHOLD)
+
+    def check(result):
+        _, total, kept = result
+        return (total, kept) == (scene["blobs"] + scene["specks"], scene["blobs"])
+
+    return run, mask.size, check
+
+
+def bench_extract_polygons(scene, work_dir):
+    from reversegeocode import extract_polygons
+
+    mask = cv2.imread(scene["mask"], cv2.IMREAD_GRAYSCALE)
+
+    def run():
+        return extract_polygons(mask, AREA_THRESHOLD)
+
+    def check(result):
+        return len(result) == scene["blobs"]
+
+    return run, mask.size, check
+
+
+def bench_split_images(scene, work_dir):
+    from split import split_images
+
+    out_dir = os.path.join(work_dir, "split")
+
+    def run():
+        split_images(scene["before"], scene["after"], scene["mask"], out_dir, TILE)
+
+    def check(result):
+        n = (scene["size"] // TILE) ** 2
+        return len(os.listdir(os.path.join(out_dir, "label"))) == n
+
+    return run, scene["size"] ** 2, check
+
+
+def bench_merge_tiles(scene, work_dir):
+    from resmerger import merge_tiles
+
+    # Model outputs as {count}per.png, cut from the known mask
+    mask = cv2.imread(scene["mask"], cv2.IMREAD_GRAYSCALE)
+    tiles_dir = os.path.join(work_dir, "tiles")
+    os.makedirs(tiles_dir, exist_ok=True)
+    n = scene["size"] // TILE
+    for count in range(n * n):
+        i, j = divmod(count, n)
+        cv2.imwrite(os.path.join(tiles_dir, f"{count}per.png"), mask[i * TILE:(i + 1) * TILE, j * TILE:(j + 1) * TILE])
+    output = os.path.join(work_dir, "merged.png")
+
+    def run():
+        merge_tiles(tiles_dir, output, n, n, TILE)
+
+    def check(result):
+        merged = cv2.imread(output, cv2.IMREAD_GRAYSCALE)
+        return (merged == mask[:n * TILE, :n * TILE]).all()
+
+    return run, (n * TILE) ** 2, check
+
+
+def bench_png_to_geotiff(scene, work_dir):
+    import rasterio
+    from png2georef import png_to_geotiff
+
+    output = os.path.join(work_dir, "mask.tif")
+
+    def run():
+        png_to_geotiff(scene["mask"], scene["reference"], output, dtype="uint8")
+
+    def check(result):
+        with rasterio.open(output) as dst, rasterio.open(scene["reference"]) as ref:
+            return dst.transform == ref.transform and dst.crs == ref.crs
+
+    return run, scene["size"] ** 2, check
+
+
+# name -> (setup, largest scene it is run on; None for no limit).
+# The polygon2mask based stages allocate a full-scene mask per contour.
+STAGES = {
+    "find_best_shift": (bench_find_best_shift, None),
+    "filter_polygons_cv2": (bench_filter_polygons_cv2, 8192),
+    "filter_components": (bench_filter_components, None),
+    "extract_polygons": (bench_extract_polygons, 8192),
+    "split_images": (bench_split_images, None),
+    "merge_tiles": (bench_merge_tiles, None),
+    "png_to_geotiff": (bench_png_to_geotiff, None),
+}
@@ -1,7 +1,13 @@
 import argparse
+import csv
+import os
 import random
+import threading
 import rasterio
-from rasterio.windows import Window
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window, from_bounds
+
+import metrics
 
 
 def crop_tiff(input_tif, output_tif, xsize, ysize, xoff=None, yoff=None, randomize=False):
@@ -36,18 +42,127 @@ def crop_tiff(input_tif, output_tif, xsize, ysize, xoff=None, yoff=None, randomi
         print(f"   Window offset: ({xoff}, {yoff}), size: ({xsize}, {ysize})")
 
 
+def read_rows(path):
+    """Read comma/whitespace separated numeric rows from a text file, skipping blanks, comments and headers."""
+    rows = []
+    with open(path, newline="") as f:
+        for line in csv.reader(f):
+            fields = " ".join(line).split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            try:
+                rows.append([float(v) for v in fields])
+            except ValueError:
+                continue  # header row
+    return rows
+
+
+def clip_windows(src, windows):
+    """
+    Clip windows to the image, dropping those entirely outside it.
+
+    Returns (index, window) pairs, where index is the window's position in
+    the input list, so outputs keep matching the input rows.
+    """
+    full = Window(0, 0, src.width, src.height)
+    clipped, skipped = [], []
+    for k, window in enumerate(windows):
+        try:
+            clipped.append((k, window.intersection(full)))
+        except rasterio.errors.WindowError:
+            skipped.append(k)
+    if skipped:
+        print(f"⚠️ Skipping {len(skipped)} window(s) outside the image, rows: {', '.join(map(str, skipped))}")
+    return clipped
+
+
+def windows_from_bboxes(src, bboxes):
+    """Convert (minx, miny, maxx, maxy) boxes in the dataset CRS to (index, pixel window) pairs inside the image."""
+    return clip_windows(src, [from_bounds(*bbox, transform=src.transform).round_offsets().round_lengths()
+                              for bbox in bboxes])
+
+
+def random_windows(src, n, xsize, ysize, seed=None):
+    """N random xsize x ysize windows fully inside the image."""
+    rng = random.Random(seed)
+    return [Window(rng.randint(0, src.width - xsize), rng.randint(0, src.height - ysize), xsize, ysize)
+            for _ in range(n)]
+
+
+def crop_windows(src, windows, output_dir, prefix="crop", workers=4):
+    """
+    Crop many windows from one open dataset and write them concurrently.
+
+    windows are (index, window) pairs; each crop is saved as
+    {prefix}_{index:05d}.tif. Reads are serialized on the shared dataset
+    handle; encoding and writing of the outputs run in a thread pool.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    lock = threading.Lock()
+
+    def crop(job):
+        k, window = job
+        with lock:
+            data = src.read(window=window)
+        profile = src.profile.copy()
+        profile.update({
+            "height": data.shape[1],
+            "width": data.shape[2],
+            "transform": src.window_transform(window),
+        })
+        out_path = os.path.join(output_dir, f"{prefix}_{k:05d}.tif")
+        with rasterio.open(out_path, "w", **profile) as dst:
+            dst.write(data)
+        return out_path
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        outputs = list(pool.map(crop, windows))
+    metrics.count(pixels=sum(int(w.width) * int(w.height) for _, w in windows), tiles=len(outputs))
+
+    print(f"✅ Cropped {len(outputs)} windows → {output_dir}")
+    return outputs
+
+
 def main():
     parser = argparse.ArgumentParser(description="Crop a GeoTIFF image.")
     parser.add_argument("-i", "--input", required=True, help="Input GeoTIFF file")
-    parser.add_argument("-o", "--output", required=True, help="Output cropped GeoTIFF file")
-    parser.add_argument("--xsize", type=int, required=True, help="Crop width in pixels")
-    parser.add_argument("--ysize", type=int, required=True, help="Crop height in pixels")
+    parser.add_argument("-o", "--output", help="Output cropped GeoTIFF file (single crop)")
+    parser.add_argument("--xsize", type=int, help="Crop width in pixels")
+    parser.add_argument("--ysize", type=int, help="Crop height in pixels")
     parser.add_argument("--xoff", type=int, default=None, help="X offset in pixels (ignored if randomize=True)")
     parser.add_argument("--yoff", type=int, default=None, help="Y offset in pixels (ignored if randomize=True)")
     parser.add_argument("--randomize", action="store_true", help="Randomize crop position")
+    batch = parser.add_mutually_exclusive_group()
+    batch.add_argument("--windows", help="Batch: file of pixel windows, one 'xoff,yoff,xsize,ysize' per line")
+    batch.add_argument("--bboxes", help="Batch: file of 'minx,miny,maxx,maxy' boxes in the dataset CRS")
+    batch.add_argument("--random", type=int, help="Batch: number of random --xsize x --ysize crops")
+    parser.add_argument("--output_dir", help="Output directory for batch crops")
+    parser.add_argument("--prefix", default="crop", help="File name prefix for batch crops (default: crop)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for --random")
+    parser.add_argument("--workers", type=int, default=4, help="Writer threads for batch crops (default: 4)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "georefCrop")
 
-    crop_tiff(args.input, args.output, args.xsize, args.ysize, args.xoff, args.yoff, args.randomize)
+    if args.windows or args.bboxes or args.random:
+        if not args.output_dir:
+            parser.error("batch cropping requires --output_dir")
+        with rasterio.open(args.input) as src:
+            if args.windows:
+                windows = clip_windows(src, [Window(*map(int, row[:4])) for row in read_rows(args.windows)])
+            elif args.bboxes:
+                windows = windows_from_bboxes(src, [row[:4] for row in read_rows(args.bboxes)])
+            else:
+                if args.xsize is None or args.ysize is None:
+                    parser.error("--random requires --xsize and --ysize")
+                windows = list(enumerate(random_windows(src, args.random, args.xsize, args.ysize, args.seed)))
+            with metrics.stage("crop_windows"):
+                crop_windows(src, windows, args.output_dir, args.prefix, args.workers)
+    else:
+        if not args.output or args.xsize is None or args.ysize is None:
+            parser.error("single crop requires -o/--output, --xsize and --ysize")
+        with metrics.stage("crop_tiff", pixels=args.xsize * args.ysize, tiles=1):
+            crop_tiff(args.input, args.output, args.xsize, args.ysize, args.xoff, args.yoff, args.randomize)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,16 @@
 import cv2
 import argparse
 import os
+import threading
+import warnings
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.errors import NotGeoreferencedWarning
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
+
+import metrics
 
 
 def histogram_equalization(input_path: str, output_path: str):
@@ -22,6 +32,115 @@ def histogram_equalization(input_path: str, output_path: str):
     # Save result
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     cv2.imwrite(output_path, equ)
+    metrics.count(pixels=img.size)
+    print(f"Equalized image saved at: {output_path}")
+
+
+def equalize_lut(hist):
+    """Histogram equalization LUT from a 256-bin histogram, computed as cv2.equalizeHist does."""
+    hist = np.asarray(hist, dtype=np.int64)
+    total = int(hist.sum())
+    nonzero = np.flatnonzero(hist)
+    if len(nonzero) == 0:
+        return np.zeros(256, dtype=np.uint8)
+    i0 = nonzero[0]
+    if hist[i0] == total:
+        return np.full(256, i0, dtype=np.uint8)
+
+    scale = 255.0 / (total - hist[i0])
+    cdf = np.cumsum(hist) - hist[i0]
+    lut = np.rint(cdf * scale)
+    lut[:i0 + 1] = 0
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+
+def clahe_tiled(img, clip_limit=2.0, tile=256):
+    """
+    CLAHE with square tiles of `tile` pixels anchored at the image origin.
+
+    The image is reflect-padded at the bottom/right to a multiple of `tile`,
+    so the tile grid depends only on the tile size, not on the image size.
+    """
+    h, w = img.shape
+    pad_y, pad_x = -h % tile, -w % tile
+    padded = cv2.copyMakeBorder(img, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT_101)
+    clahe = cv2.createCLAHE(clipLimit=clip_limit,
+                            tileGridSize=(padded.shape[1] // tile, padded.shape[0] // tile))
+    return clahe.apply(padded)[:h, :w]
+
+
+def histogram_equalization_blockwise(input_path, output_path, clahe=False, clip_limit=2.0, tile=256,
+                                     block_rows=2048, workers=4):
+    """
+    Histogram equalization (or CLAHE) of a full scene in row blocks with bounded memory.
+
+    Global equalization builds the histogram from windowed reads, then maps
+    each block through the cv2.equalizeHist LUT. CLAHE reads each block with
+    a one-tile halo above and below, so every block sees the same tile grid
+    as clahe_tiled on the whole image and the output has no seams. Blocks are
+    processed in a thread pool; reads and writes are serialized on the
+    shared datasets.
+
+    Args:
+        input_path (str): Path to the input 8-bit image (first band is used).
+        output_path (str): Path to save the equalized image (.tif written directly,
+            other formats through a temporary GeoTIFF).
+        clahe (bool): Use CLAHE instead of global equalization.
+        clip_limit (float): CLAHE clip limit.
+        tile (int): CLAHE tile size in pixels.
+        block_rows (int): Rows per block (rounded up to a multiple of tile).
+        workers (int): Worker threads.
+    """
+    block_rows = -(-block_rows // tile) * tile
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    direct = output_path.lower().endswith((".tif", ".tiff"))
+    tmp_path = output_path if direct else f"{os.path.splitext(output_path)[0]}.tmp.tif"
+    lock = threading.Lock()
+
+    with warnings.catch_warnings(action="ignore", category=NotGeoreferencedWarning), \
+            rasterio.open(input_path) as src:
+        if src.dtypes[0] != "uint8":
+            raise ValueError(f"Expected an 8-bit image, got {src.dtypes[0]}")
+        h, w = src.height, src.width
+        starts = range(0, h, block_rows)
+        metrics.count(pixels=h * w, tiles=len(starts))
+
+        lut = None
+        if not clahe:
+            hist = np.zeros(256, dtype=np.int64)
+            for y0 in starts:
+                block = src.read(1, window=Window(0, y0, w, min(block_rows, h - y0)))
+                hist += np.bincount(block.ravel(), minlength=256)
+            lut = equalize_lut(hist)
+
+        profile = {"driver": "GTiff", "count": 1, "height": h, "width": w, "dtype": "uint8",
+                   "tiled": True, "blockxsize": 256, "blockysize": 256, "BIGTIFF": "IF_SAFER"}
+        if src.crs is not None:
+            profile.update(crs=src.crs, transform=src.transform)
+
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            def work(y0):
+                y1 = min(y0 + block_rows, h)
+                if clahe:
+                    ey0, ey1 = max(y0 - tile, 0), min(y1 + tile, h)
+                    with lock:
+                        band = src.read(1, window=Window(0, ey0, w, ey1 - ey0))
+                    out = clahe_tiled(band, clip_limit, tile)[y0 - ey0:y1 - ey0]
+                else:
+                    with lock:
+                        band = src.read(1, window=Window(0, y0, w, y1 - y0))
+                    out = cv2.LUT(band, lut)
+                with lock:
+                    dst.write(out, 1, window=Window(0, y0, w, y1 - y0))
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(work, starts))
+
+    if not direct:
+        try:
+            rasterio.shutil.copy(tmp_path, output_path)
+        finally:
+            os.remove(tmp_path)
     print(f"Equalized image saved at: {output_path}")
 
 
@@ -33,9 +152,27 @@ def main():
     parser.add_argument(
         "-o", "--output", required=True, help="Path to save the equalized image"
     )
+    parser.add_argument(
+        "--blockwise", action="store_true", help="Stream the scene in row blocks (bounded memory)"
+    )
+    parser.add_argument(
+        "--clahe", action="store_true", help="Use CLAHE instead of global equalization (implies --blockwise)"
+    )
+    parser.add_argument("--clip_limit", type=float, default=2.0, help="CLAHE clip limit (default: 2.0)")
+    parser.add_argument("--tile", type=int, default=256, help="CLAHE tile size in pixels (default: 256)")
+    parser.add_argument("--block_rows", type=int, default=2048, help="Rows per block (default: 2048)")
+    parser.add_argument("--workers", type=int, default=4, help="Worker threads (default: 4)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "histoeq")
 
-    histogram_equalization(args.input, args.output)
+    if args.blockwise or args.clahe:
+        with metrics.stage("clahe_blockwise" if args.clahe else "equalize_blockwise"):
+            histogram_equalization_blockwise(args.input, args.output, clahe=args.clahe, clip_limit=args.clip_limit,
+                                             tile=args.tile, block_rows=args.block_rows, workers=args.workers)
+    else:
+        with metrics.stage("equalize"):
+            histogram_equalization(args.input, args.output)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,76 @@
 import argparse
+import queue
+import threading
 import cv2
+import numpy as np
 from skimage.exposure import match_histograms
-from skimage.filters import unsharp_mask
+
+import metrics
+
+
+class BackgroundWriter:
+    """Write images with cv2.imwrite from a background thread through a bounded queue."""
+
+    def __init__(self, maxsize=2):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, img, message = item
+                try:
+                    ok = cv2.imwrite(path, img)
+                except Exception as e:  # keep draining the queue so write()/close() never block
+                    self.errors.append(f"{path}: {str(e).strip()}")
+                    continue
+                if not ok:
+                    self.errors.append(f"{path}: cv2.imwrite failed")
+                elif message:
+                    print(message)
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, img, message=None):
+        self.queue.put((path, img, message))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.errors:
+            raise IOError(f"Could not write {len(self.errors)} image(s):\n" + "\n".join(self.errors))
+
+
+def unsharp_sweep(image, unsharp_params):
+    """
+    Unsharp mask one image with many (radius, amount) pairs.
+
+    The image is converted to float32 in [0, 1] once and each distinct radius
+    is blurred once (cv2 Gaussian, 4-sigma kernel, reflect border, as
+    skimage.filters.unsharp_mask); the detail layer is reused for every
+    amount. Yields (idx, radius, amount, uint8 result) with idx following the
+    order of unsharp_params (1-based).
+    """
+    fimg = np.asarray(image, dtype=np.float32) * np.float32(1 / 255)
+
+    by_radius = {}
+    for idx, (radius, amount) in enumerate(unsharp_params, start=1):
+        by_radius.setdefault(radius, []).append((idx, amount))
+
+    for radius, amounts in by_radius.items():
+        blurred = cv2.GaussianBlur(fimg, (0, 0), sigmaX=radius, borderType=cv2.BORDER_REFLECT)
+        detail = cv2.subtract(fimg, blurred)
+        del blurred
+        for idx, amount in amounts:
+            result = cv2.scaleAdd(detail, float(amount), fimg)
+            np.clip(result, 0, 1, out=result)
+            result *= 255
+            yield idx, radius, amount, result.astype(np.uint8)
 
 
 def process_image(image_path, reference_path, output_prefix, save_hist=True, unsharp_params=None):
@@ -16,22 +85,25 @@ def process_image(image_path, reference_path, output_prefix, save_hist=True, uns
 
     print(f"Input image shape: {image.shape}, Reference shape: {reference.shape}")
 
-    # Histogram matching
-    matched = match_histograms(image, reference)
-    if save_hist:
-        hist_out = f"{output_prefix}_histmatched.png"
-        cv2.imwrite(hist_out, matched)
-        print(f"✅ Saved histogram matched image → {hist_out}")
+    # Histogram matching (skimage returns float64 on the uint8 scale)
+    with metrics.stage("match_histograms", pixels=image.size):
+        matched = np.clip(np.rint(match_histograms(image, reference)), 0, 255).astype(np.uint8)
+
+    writer = BackgroundWriter()
+    try:
+        if save_hist:
+            hist_out = f"{output_prefix}_histmatched.png"
+            writer.write(hist_out, matched, f"✅ Saved histogram matched image → {hist_out}")
 
-    # Apply unsharp masks with given parameter sets
-    if unsharp_params:
-        for idx, (radius, amount) in enumerate(unsharp_params, start=1):
-            result = unsharp_mask(matched, radius=radius, amount=amount)
-            # Convert back to uint8 (skimage returns float in [0,1])
-            result = (result * 255).clip(0, 255).astype("uint8")
-            out_path = f"{output_prefix}_um{idx}.png"
-            cv2.imwrite(out_path, result)
-            print(f"✅ Saved unsharp mask result (radius={radius}, amount={amount}) → {out_path}")
+        # Apply unsharp masks with given parameter sets
+        if unsharp_params:
+            with metrics.stage("unsharp_sweep", pixels=matched.size * len(unsharp_params)):
+                for idx, radius, amount, result in unsharp_sweep(matched, unsharp_params):
+                    out_path = f"{output_prefix}_um{idx}.png"
+                    writer.write(out_path, result,
+                                 f"✅ Saved unsharp mask result (radius={radius}, amount={amount}) → {out_path}")
+    finally:
+        writer.close()
 
 
 def main():
@@ -42,7 +114,9 @@ def main():
     parser.add_argument("--skip-hist", action="store_true", help="Skip saving histogram matched image")
     parser.add_argument("--unsharp", nargs="+", type=float, default=[1, 1, 5, 2, 20, 1],
                         help="Unsharp params as radius,amount pairs (e.g., --unsharp 1 1 5 2 20 1)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "histogramMatch")
 
     # Parse unsharp params into list of (radius, amount)
     if len(args.unsharp) % 2 != 0:
@@ -50,9 +124,10 @@ def main():
 
     unsharp_params = [(args.unsharp[i], args.unsharp[i + 1]) for i in range(0, len(args.unsharp), 2)]
 
-    process_image(args.input, args.reference, args.output,
-                  save_hist=not args.skip_hist,
-                  unsharp_params=unsharp_params)
+    with metrics.stage("process_image"):
+        process_image(args.input, args.reference, args.output,
+                      save_hist=not args.skip_hist,
+                      unsharp_params=unsharp_params)
 
 
 if __name__ == "__main__":
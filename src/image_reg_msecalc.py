@@ -1,12 +1,17 @@
 import cv2
 import numpy as np
 import argparse
+import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
 
 
 def mse(a, b):
     """Compute Mean Squared Error between two arrays."""
-    return np.mean((a - b) ** 2)
+    return np.mean((a.astype(np.float64) - b) ** 2)
 
 
 def find_best_shift(img1, img2, start_x=5000, start_y=5000, wsize=6000, shift_range=20):
@@ -45,14 +50,285 @@ def find_best_shift(img1, img2, start_x=5000, start_y=5000, wsize=6000, shift_ra
     return best_shift, min_error
 
 
+def find_shift_phase(img1, img2, start_x=5000, start_y=5000, wsize=6000):
+    """
+    Find alignment (shift) between two images using FFT phase correlation.
+
+    The cross-power spectrum of the two windows is computed once and the
+    correlation peak is refined to subpixel accuracy, so the cost does not
+    depend on the search range.
+
+    Args:
+        img1: Reference image (grayscale).
+        img2: Target image (grayscale).
+        start_x, start_y: Starting coordinates for the window.
+        wsize: Window size for patch comparison.
+
+    Returns:
+        (best_dx, best_dy, min_error), with the same sign convention as
+        find_best_shift and the MSE evaluated at the nearest integer shift.
+    """
+    patch_ref = img1[start_y:start_y+wsize, start_x:start_x+wsize].astype(np.float32)
+    patch_target = img2[start_y:start_y+wsize, start_x:start_x+wsize].astype(np.float32)
+    if patch_ref.shape != patch_target.shape or patch_ref.size == 0:
+        raise ValueError("Window falls outside one or both images")
+
+    window = cv2.createHanningWindow(patch_ref.shape[::-1], cv2.CV_32F)
+    # phaseCorrelate applies the window to its inputs in place, so pass copies
+    (dx, dy), response = cv2.phaseCorrelate(patch_ref.copy(), patch_target.copy(), window)
+    print(f"Phase correlation peak: dx={dx:.3f}, dy={dy:.3f}, response={response:.4f}")
+
+    ix, iy = int(round(dx)), int(round(dy))
+    patch_shifted = img2[start_y+iy:start_y+iy+wsize, start_x+ix:start_x+ix+wsize]
+    if patch_shifted.shape == patch_ref.shape:
+        error = mse(img1[start_y:start_y+wsize, start_x:start_x+wsize], patch_shifted)
+    else:
+        error = float("inf")
+
+    return (dx, dy), error
+
+
+def _search_shift(patch_ref, region, margin, center, radius):
+    """MSE search of patch_ref inside region around center, within +/- radius."""
+    h, w = patch_ref.shape
+    cx, cy = center
+    min_error = float("inf")
+    best_shift = center
+
+    for dx in range(cx - radius, cx + radius + 1):
+        for dy in range(cy - radius, cy + radius + 1):
+            y0, x0 = margin + dy, margin + dx
+            if y0 < 0 or x0 < 0:
+                continue
+            patch_target = region[y0:y0+h, x0:x0+w]
+            if patch_target.shape != patch_ref.shape:
+                continue
+            error = mse(patch_ref, patch_target)
+            if error < min_error:
+                min_error = error
+                best_shift = (dx, dy)
+
+    return best_shift, min_error
+
+
+def find_shift_pyramid(img1, img2, start_x=5000, start_y=5000, wsize=6000, shift_range=20,
+                       levels=None, refine=2):
+    """
+    Find best alignment (shift) between two images with a coarse-to-fine Gaussian pyramid.
+
+    The full +/- shift_range search is done only at the coarsest level; every
+    finer level doubles the estimate and searches +/- refine pixels around it,
+    so the cost stays roughly constant as shift_range grows.
+
+    Args:
+        img1: Reference image (grayscale).
+        img2: Target image (grayscale).
+        start_x, start_y: Starting coordinates for the window.
+        wsize: Window size for patch comparison.
+        shift_range: Maximum pixels to shift in both directions.
+        levels: Number of pyramid reductions (default: chosen from shift_range).
+        refine: Search radius in pixels at each finer level.
+
+    Returns:
+        (best_dx, best_dy, min_error)
+    """
+    if levels is None:
+        levels = max(0, math.ceil(math.log2(max(shift_range, 1) / 4)))
+    # Keep at least 32 px of window at the coarsest level
+    while levels > 0 and wsize >> levels < 32:
+        levels -= 1
+
+    scale = 2 ** levels
+    margin = math.ceil(shift_range / scale) * scale + refine * scale
+
+    patch_ref = img1[start_y:start_y+wsize, start_x:start_x+wsize]
+    if patch_ref.shape != (wsize, wsize):
+        raise ValueError("Window falls outside the reference image")
+
+    # Target window plus margin; reflect where the margin leaves the image
+    h2, w2 = img2.shape[:2]
+    y0, y1 = start_y - margin, start_y + wsize + margin
+    x0, x1 = start_x - margin, start_x + wsize + margin
+    region = img2[max(y0, 0):min(y1, h2), max(x0, 0):min(x1, w2)]
+    region = cv2.copyMakeBorder(region,
+                                max(-y0, 0), max(y1 - h2, 0),
+                                max(-x0, 0), max(x1 - w2, 0),
+                                cv2.BORDER_REFLECT)
+
+    refs, regions = [patch_ref], [region]
+    for _ in range(levels):
+        refs.append(cv2.pyrDown(refs[-1]))
+        regions.append(cv2.pyrDown(regions[-1]))
+
+    best_shift, min_error = (0, 0), float("inf")
+    for level in range(levels, -1, -1):
+        t0 = time.perf_counter()
+        if level == levels:
+            center = (0, 0)
+            radius = math.ceil(shift_range / scale)
+        else:
+            center = (best_shift[0] * 2, best_shift[1] * 2)
+            radius = refine
+        best_shift, min_error = _search_shift(refs[level], regions[level],
+                                              margin >> level, center, radius)
+        print(f"Level {level} (1/{2 ** level}, +/-{radius} px): "
+              f"dx={best_shift[0] * 2 ** level}, dy={best_shift[1] * 2 ** level}, "
+              f"MSE={min_error:.3f}, {time.perf_counter() - t0:.2f}s")
+
+    return best_shift, min_error
+
+
 def apply_shift(img, dx, dy):
-    """Apply pixel shift to an image."""
+    """Apply pixel shift to an image, so that shifted[y, x] = img[y + dy, x + dx]."""
     rows, cols = img.shape
     M = np.float32([[1, 0, dx], [0, 1, dy]])
-    shifted = cv2.warpAffine(img, M, (cols, rows))
+    shifted = cv2.warpAffine(img, M, (cols, rows), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
     return shifted
 
 
+def _tile_shift(job):
+    """Phase-correlate one reference/target tile pair (process pool worker)."""
+    i, j, tile_ref, tile_target = job
+    tile_ref = tile_ref.astype(np.float32)
+    tile_target = tile_target.astype(np.float32)
+    if tile_ref.std() < 1.0 or tile_target.std() < 1.0:
+        return i, j, 0.0, 0.0, 0.0  # flat tile (water, cloud, no-data)
+    window = cv2.createHanningWindow(tile_ref.shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(tile_ref, tile_target, window)
+    return i, j, dx, dy, response
+
+
+def _local_plane(grid, mask, i, j):
+    """
+    Robust planar prediction of grid[i, j] from the masked cells of its 3x3
+    neighbourhood (the cell itself excluded), or None if there are none.
+
+    The row and column gradients are the medians of the differences between
+    adjacent masked cells, and the prediction is the median of the
+    neighbours carried to (i, j) along that plane. Unlike a plain neighbour
+    median this stays unbiased under linear drift when the neighbourhood is
+    one-sided (border tiles), and one outlying neighbour barely moves it.
+    """
+    i0, j0 = max(i - 1, 0), max(j - 1, 0)
+    g = grid[i0:i + 2, j0:j + 2].astype(np.float64)
+    m = mask[i0:i + 2, j0:j + 2].copy()
+    m[i - i0, j - j0] = False
+    if not m.any():
+        return None
+
+    dcol = (g[:, 1:] - g[:, :-1])[m[:, 1:] & m[:, :-1]]
+    drow = (g[1:] - g[:-1])[m[1:] & m[:-1]]
+    gcol = np.median(dcol) if dcol.size else 0.0
+    grow = np.median(drow) if drow.size else 0.0
+
+    ii, jj = np.nonzero(m)
+    return np.median(g[ii, jj] + grow * (i - i0 - ii) + gcol * (j - j0 - jj))
+
+
+def estimate_shift_field(img1, img2, tile=1024, workers=None, min_response=0.05, max_dev=3.0):
+    """
+    Estimate a local shift on a grid of tiles and reject outliers.
+
+    Each tile is phase-correlated in a process pool. Tiles with a weak
+    correlation peak, or whose shift is more than max_dev pixels from the
+    local plane through their reliable 3x3 neighbours (see _local_plane),
+    are replaced by the plane through their valid neighbours. Testing
+    against a local plane rather than the global median keeps smoothly
+    varying drift across the scene, including at the border tiles.
+
+    Args:
+        img1: Reference image (grayscale).
+        img2: Target image (grayscale).
+        tile: Tile size in pixels.
+        workers: Number of worker processes (default: all cores).
+        min_response: Minimum phase correlation peak response to accept a tile.
+        max_dev: Maximum deviation (pixels) from the local plane of the neighbours' shifts.
+
+    Returns:
+        (dx_grid, dy_grid, valid) float32 / bool arrays of shape (rows, cols).
+    """
+    h, w = img1.shape[:2]
+    rows, cols = h // tile, w // tile
+    if rows == 0 or cols == 0:
+        raise ValueError(f"Image {img1.shape} is smaller than one tile ({tile} px)")
+
+    jobs = ((i, j,
+             img1[i*tile:(i+1)*tile, j*tile:(j+1)*tile],
+             img2[i*tile:(i+1)*tile, j*tile:(j+1)*tile])
+            for i in range(rows) for j in range(cols))
+
+    dx_grid = np.zeros((rows, cols), dtype=np.float32)
+    dy_grid = np.zeros((rows, cols), dtype=np.float32)
+    response = np.zeros((rows, cols), dtype=np.float32)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, j, dx, dy, r in pool.map(_tile_shift, jobs, chunksize=max(1, cols // 4)):
+            dx_grid[i, j], dy_grid[i, j], response[i, j] = dx, dy, r
+
+    reliable = response >= min_response
+    if not reliable.any():
+        raise ValueError("No tile produced a reliable shift estimate")
+
+    med_dx, med_dy = np.median(dx_grid[reliable]), np.median(dy_grid[reliable])
+    valid = reliable.copy()
+    for i, j in zip(*np.nonzero(reliable)):
+        ref_dx = _local_plane(dx_grid, reliable, i, j)
+        if ref_dx is None:
+            ref_dx, ref_dy = med_dx, med_dy  # isolated tile: fall back to the global median
+        else:
+            ref_dy = _local_plane(dy_grid, reliable, i, j)
+        valid[i, j] = np.hypot(dx_grid[i, j] - ref_dx, dy_grid[i, j] - ref_dy) <= max_dev
+
+    fill_dx, fill_dy = dx_grid.copy(), dy_grid.copy()
+    for i, j in zip(*np.nonzero(~valid)):
+        pred_dx = _local_plane(fill_dx, valid, i, j)
+        if pred_dx is None:
+            dx_grid[i, j], dy_grid[i, j] = med_dx, med_dy
+        else:
+            dx_grid[i, j], dy_grid[i, j] = pred_dx, _local_plane(fill_dy, valid, i, j)
+
+    return dx_grid, dy_grid, valid
+
+
+def _tile_weights(n, size, tile):
+    """
+    Index and weight to interpolate a grid of n tile centres at (k + 0.5) * tile
+    onto size pixels, extrapolating linearly beyond the first and last centre.
+    """
+    u = (np.arange(size, dtype=np.float32) + 0.5) / tile - 0.5
+    if n == 1:
+        return np.zeros(size, dtype=np.intp), np.zeros(size, dtype=np.float32)
+    k = np.clip(np.floor(u), 0, n - 2).astype(np.intp)
+    return k, (u - k).astype(np.float32)
+
+
+def _interp_grid(grid, shape, tile):
+    """Bilinearly interpolate a (rows, cols) per-tile grid to a full-resolution float32 map."""
+    ki, ti = _tile_weights(grid.shape[0], shape[0], tile)
+    kj, tj = _tile_weights(grid.shape[1], shape[1], tile)
+    grid = grid.astype(np.float32)
+    cols = grid[:, kj] + (grid[:, np.minimum(kj + 1, grid.shape[1] - 1)] - grid[:, kj]) * tj
+    return cols[ki] + (cols[np.minimum(ki + 1, grid.shape[0] - 1)] - cols[ki]) * ti[:, None]
+
+
+def apply_shift_field(img, dx_grid, dy_grid, tile=1024):
+    """
+    Warp an image with a smooth displacement field in a single cv2.remap.
+
+    The per-tile shifts of estimate_shift_field (same tile size) are placed
+    at the tile centres and bilinearly interpolated to full resolution,
+    extrapolating linearly to the image border, so that
+    warped[y, x] = img[y + dy(y, x), x + dx(y, x)].
+    """
+    rows, cols = img.shape[:2]
+    map_x = _interp_grid(dx_grid, (rows, cols), tile)
+    map_x += np.arange(cols, dtype=np.float32)[None, :]
+    map_y = _interp_grid(dy_grid, (rows, cols), tile)
+    map_y += np.arange(rows, dtype=np.float32)[:, None]
+
+    return cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Image registration via pixel shift MSE minimization")
     parser.add_argument("-r", "--reference", required=True, help="Path to reference image (grayscale)")
@@ -61,31 +337,85 @@ def main():
     parser.add_argument("--start_x", type=int, default=5000, help="X coordinate for patch start")
     parser.add_argument("--start_y", type=int, default=5000, help="Y coordinate for patch start")
     parser.add_argument("--wsize", type=int, default=6000, help="Window size")
-    parser.add_argument("--shift", type=int, default=20, help="Shift range (+/-)")
+    parser.add_argument("--shift", type=int, default=20, help="Shift range (+/-), used by --method mse/pyramid")
+    parser.add_argument("--method", choices=["phase", "mse", "pyramid", "field"], default="phase",
+                        help="Registration method (FFT phase correlation, brute-force MSE search, "
+                             "coarse-to-fine pyramid MSE search or tile-wise local shift field)")
+    parser.add_argument("--levels", type=int, default=None,
+                        help="Pyramid levels for --method pyramid (default: chosen from --shift)")
+    parser.add_argument("--refine", type=int, default=2,
+                        help="Per-level search radius for --method pyramid (default: 2)")
+    parser.add_argument("--tile", type=int, default=1024,
+                        help="Tile size for --method field (default: 1024)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for --method field (default: all cores)")
+    parser.add_argument("--min_response", type=float, default=0.05,
+                        help="Minimum phase correlation response of a tile for --method field (default: 0.05)")
+    parser.add_argument("--max_dev", type=float, default=3.0,
+                        help="Maximum tile shift deviation (px) from its 3x3 neighbourhood median "
+                             "for --method field (default: 3.0)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "image_reg_msecalc")
 
     # Load images
-    img1 = cv2.imread(args.reference, cv2.IMREAD_GRAYSCALE)
-    img2 = cv2.imread(args.target, cv2.IMREAD_GRAYSCALE)
+    with metrics.stage("load") as s:
+        img1 = cv2.imread(args.reference, cv2.IMREAD_GRAYSCALE)
+        img2 = cv2.imread(args.target, cv2.IMREAD_GRAYSCALE)
 
-    if img1 is None or img2 is None:
-        raise FileNotFoundError("Could not read one or both images")
+        if img1 is None or img2 is None:
+            raise FileNotFoundError("Could not read one or both images")
+        s.count(pixels=img1.size + img2.size)
 
     print(f"Reference shape: {img1.shape}, Target shape: {img2.shape}")
 
+    if args.method == "field":
+        with metrics.stage("estimate_shift_field", pixels=img1.size) as s:
+            dx_grid, dy_grid, valid = estimate_shift_field(img1, img2, tile=args.tile, workers=args.workers,
+                                                           min_response=args.min_response, max_dev=args.max_dev)
+            s.count(tiles=dx_grid.size)
+        print(f"\nShift field: {dx_grid.shape[0]} x {dx_grid.shape[1]} tiles, "
+              f"{int(valid.sum())} valid, dx={dx_grid.min():.2f}..{dx_grid.max():.2f}, "
+              f"dy={dy_grid.min():.2f}..{dy_grid.max():.2f}")
+        with metrics.stage("apply_shift_field", pixels=img2.size):
+            aligned = apply_shift_field(img2, dx_grid, dy_grid, tile=args.tile)
+        with metrics.stage("save", pixels=aligned.size):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+            cv2.imwrite(args.output, aligned)
+        print(f"Aligned image saved at: {args.output}")
+        return
+
     # Find best shift
-    (dx, dy), error = find_best_shift(img1, img2,
-                                      start_x=args.start_x,
-                                      start_y=args.start_y,
-                                      wsize=args.wsize,
-                                      shift_range=args.shift)
+    window = img1[args.start_y:args.start_y + args.wsize, args.start_x:args.start_x + args.wsize]
+    with metrics.stage(f"find_shift_{args.method}", pixels=window.size):
+        if args.method == "phase":
+            (dx, dy), error = find_shift_phase(img1, img2,
+                                               start_x=args.start_x,
+                                               start_y=args.start_y,
+                                               wsize=args.wsize)
+        elif args.method == "pyramid":
+            (dx, dy), error = find_shift_pyramid(img1, img2,
+                                                 start_x=args.start_x,
+                                                 start_y=args.start_y,
+                                                 wsize=args.wsize,
+                                                 shift_range=args.shift,
+                                                 levels=args.levels,
+                                                 refine=args.refine)
+        else:
+            (dx, dy), error = find_best_shift(img1, img2,
+                                              start_x=args.start_x,
+                                              start_y=args.start_y,
+                                              wsize=args.wsize,
+                                              shift_range=args.shift)
 
     print(f"\nBest shift: dx={dx}, dy={dy}, with MSE={error}")
 
     # Apply shift and save
-    aligned = apply_shift(img2, dx, dy)
-    os.makedirs(os.path.dirname(args.output), exist_ok=True)
-    cv2.imwrite(args.output, aligned)
+    with metrics.stage("apply_shift", pixels=img2.size):
+        aligned = apply_shift(img2, dx, dy)
+    with metrics.stage("save", pixels=aligned.size):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        cv2.imwrite(args.output, aligned)
     print(f"Aligned image saved at: {args.output}")
 
 
@@ -0,0 +1,208 @@
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+
+import metrics
+from split import ShardReader, read_index
+
+_reader = None
+
+
+class DummyChangeNet(torch.nn.Module):
+    """
+    Small siamese conv net with fixed random weights, for benchmarking the
+    inference loop without a trained model. Same call signature and output
+    layout (N, 2, H, W) as the real change detection model.
+    """
+
+    def __init__(self, width=16):
+        super().__init__()
+        torch.manual_seed(0)
+        self.encoder = torch.nn.Sequential(
+            torch.nn.Conv2d(3, width, 3, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(width, width, 3, padding=1), torch.nn.ReLU(),
+        )
+        self.head = torch.nn.Conv2d(width, 2, 1)
+
+    def forward(self, a, b):
+        return self.head(torch.abs(self.encoder(a) - self.encoder(b)))
+
+
+def load_model(path, threads=None, inter_op_threads=None):
+    """
+    Load a change detection model for CPU inference.
+
+    path is a TorchScript file, an .onnx file (run through ONNX Runtime with
+    the given intra/inter-op thread counts, see onnxinfer.py) or "dummy" for
+    the DummyChangeNet.
+    """
+    if path == "dummy":
+        return DummyChangeNet().eval()
+    if path.endswith(".onnx"):
+        from onnxinfer import OnnxChangeModel  # onnxruntime is only needed for ONNX models
+        return OnnxChangeModel(path, threads, inter_op_threads)
+    return torch.jit.load(path, map_location="cpu").eval()
+
+
+def to_tensor(patches):
+    """Stack uint8 (H, W) or (H, W, C) patches into a float (N, 3, H, W) batch in [0, 1]."""
+    batch = torch.from_numpy(np.ascontiguousarray(patches)).float().div_(255)
+    if batch.ndim == 3:
+        return batch.unsqueeze(1).expand(-1, 3, -1, -1).contiguous()  # grey -> 3 channels
+    return batch.permute(0, 3, 1, 2).contiguous()
+
+
+def to_masks(output):
+    """Model output (N, 1, H, W) logits or (N, C, H, W) class scores -> uint8 (N, H, W) 0/255 change masks."""
+    changed = output[:, 0] > 0 if output.shape[1] == 1 else output.argmax(1) == 1
+    return np.asarray(changed).astype(np.uint8) * 255
+
+
+def predict(model, before, after):
+    """Run the model on one batch of before/after uint8 patches, returning 0/255 masks."""
+    with torch.inference_mode():
+        return to_masks(model(to_tensor(before), to_tensor(after)))
+
+
+def _is_sharded(index):
+    return index is not None and index.get("format") == "npy-shards"
+
+
+def count_patches(patch_dir):
+    """Number of A/B patch pairs written by split.py (either layout)."""
+    index = read_index(patch_dir)
+    if index is not None:
+        return index["count"]
+    a_dir = os.path.join(patch_dir, "A")
+    if not os.path.isdir(a_dir):
+        raise FileNotFoundError(f"{patch_dir} is not a split.py output directory (no index.json or A/)")
+    return sum(1 for e in os.scandir(a_dir) if e.name.endswith(".png"))
+
+
+def _read_patch(patch_dir, sub, i):
+    if _reader is not None:
+        return np.asarray(_reader.get(i, sub))
+    path = os.path.join(patch_dir, sub, f"w{i}.png")
+    patch = cv2.imread(path, cv2.IMREAD_UNCHANGED if sub == "label" else cv2.IMREAD_COLOR)
+    if patch is None:
+        raise FileNotFoundError(f"Missing patch {path}")
+    return patch
+
+
+def _init_reader(patch_dir):
+    global _reader
+    _reader = ShardReader(patch_dir) if _is_sharded(read_index(patch_dir)) else None
+
+
+def _read_batch(job):
+    patch_dir, start, stop, subsets = job
+    return (start, *(np.stack([_read_patch(patch_dir, sub, i) for i in range(start, stop)]) for sub in subsets))
+
+
+def iter_batches(patch_dir, total, batch_size, workers=1, prefetch=None, subsets=("A", "B")):
+    """
+    Yield (start, *patches) batches in order, one stacked array per subset
+    (default: before, after).
+
+    With workers > 1 batches are decoded by a process pool, keeping up to
+    `prefetch` (default 2 * workers) batches in flight so reading overlaps
+    with inference in the main process.
+    """
+    jobs = [(patch_dir, s, min(s + batch_size, total), subsets) for s in range(0, total, batch_size)]
+    if workers <= 1:
+        _init_reader(patch_dir)
+        for job in jobs:
+            yield _read_batch(job)
+        return
+
+    prefetch = prefetch or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_reader, initargs=(patch_dir,)) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.submit(_read_batch, job))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_inference(patch_dir, output_dir, model_path, batch_size=32, workers=1, threads=None, compression=None):
+    """
+    Predict change masks for all A/B patch pairs and save them as {count}per.png.
+
+    Args:
+        patch_dir (str): Output directory of split.py (PNG or npy shard layout).
+        output_dir (str): Directory for {count}per.png masks, as read by resmerger.merge_tiles.
+        model_path (str): TorchScript or ONNX model called as model(before, after), or "dummy".
+        batch_size (int): Patches per forward pass (default=32).
+        workers (int): Reader processes prefetching batches (default=1, read inline).
+        threads (int): Torch / ONNX Runtime intra-op threads (default: all CPUs).
+        compression (int): PNG compression level 0-9 (default: OpenCV default).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    torch.set_num_threads(threads or os.cpu_count())
+    model = load_model(model_path, threads)
+    params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    total = count_patches(patch_dir)
+    if total == 0:
+        raise ValueError(f"No patches found in {patch_dir}")
+    print(f"Running {model_path} on {total} patch pairs (batch {batch_size}, "
+          f"{torch.get_num_threads()} threads, {workers} readers)")
+
+    def write(path, mask):
+        if not cv2.imwrite(path, mask, params):
+            raise IOError(f"Could not write {path}")
+
+    t0 = time.perf_counter()
+    t_model = 0.0
+    count = 0
+    with ThreadPoolExecutor(max_workers=2) as writer:
+        pending = []
+        for start, before, after in iter_batches(patch_dir, total, batch_size, workers):
+            t1 = time.perf_counter()
+            masks = predict(model, before, after)
+            t_model += time.perf_counter() - t1
+
+            # Wait for the previous batch's PNGs so at most two batches are held
+            for f in pending:
+                f.result()
+            pending = [writer.submit(write, os.path.join(output_dir, f"{start + k}per.png"), m)
+                       for k, m in enumerate(masks)]
+            count += len(masks)
+            metrics.count(pixels=masks.size, tiles=len(masks))
+        for f in pending:
+            f.result()
+
+    elapsed = time.perf_counter() - t0
+    print(f"Predicted {count} tiles into {output_dir} in {elapsed:.2f}s ({count / elapsed:.1f} tiles/s, "
+          f"model {count / max(t_model, 1e-9):.1f} tiles/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched CPU change detection inference on split.py patches")
+    parser.add_argument("-i", "--input_dir", required=True, help="split.py output directory (A/, B/ or index.json)")
+    parser.add_argument("-o", "--output_dir", required=True, help="Directory for {count}per.png predictions")
+    parser.add_argument("-m", "--model", required=True,
+                        help="TorchScript or .onnx model path, or 'dummy' for benchmarking")
+    parser.add_argument("--batch_size", type=int, default=32, help="Patches per forward pass (default=32)")
+    parser.add_argument("--workers", type=int, default=1, help="Reader processes prefetching batches (default=1)")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads (default: all CPUs)")
+    parser.add_argument("--png_compression", type=int, choices=range(10), default=None, metavar="0-9",
+                        help="PNG compression level (default: OpenCV default)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args, "inference")
+
+    with metrics.stage("run_inference"):
+        run_inference(args.input_dir, args.output_dir, args.model, args.batch_size, args.workers,
+                      args.threads, args.png_compression)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 import os
 import cv2
 import argparse
+import json
 import numpy as np
-import torch
+from concurrent.futures import ProcessPoolExecutor
 from skimage.measure import find_contours, approximate_polygon
 from skimage.draw import polygon2mask
 
+import metrics
+
 
 def mask2poly(mask, tolerance=1):
     """Convert binary mask to polygons using skimage."""
@@ -37,12 +40,12 @@ def filter_polygons_cv2(img, th):
     for cnt in contours:
         coords = [[p[0][1], p[0][0]] for p in cnt]  # (x,y) -> (row,col)
         polygon = np.array(coords)
-        maskt = torch.from_numpy(polygon2mask(img.shape, polygon))
+        maskt = polygon2mask(img.shape, polygon)
 
         total += 1
-        if torch.count_nonzero(maskt).item() >= th:
+        if np.count_nonzero(maskt) >= th:
             kept += 1
-            maskr += (polygon2mask(img.shape, polygon).astype(np.uint8) * 255)
+            maskr += (maskt.astype(np.uint8) * 255)
 
     return maskr, total, kept
 
@@ -57,44 +60,222 @@ def filter_polygons_skimage(img, th):
 
     for polygon in polygons:
         polygon = np.array(polygon)
-        maskt = torch.from_numpy(polygon2mask(img.shape, polygon))
+        maskt = polygon2mask(img.shape, polygon)
 
         total += 1
-        if torch.count_nonzero(maskt).item() >= th:
+        if np.count_nonzero(maskt) >= th:
             kept += 1
-            maskr += (polygon2mask(img.shape, polygon).astype(np.uint8) * 255)
+            maskr += (maskt.astype(np.uint8) * 255)
 
     return maskr, total, kept
 
 
-def process_dataset(input_dir, output_dir, th, mode="cv2", ext=".png"):
-    """Process all masks in dataset, save rectified ones."""
-    os.makedirs(output_dir, exist_ok=True)
+def _component_regions(comp, th):
+    """
+    Contour regions of one 8-connected component, as filter_polygons_cv2 rasterizes them.
+
+    comp is the component's boolean bounding-box crop. Returns (cover, total,
+    kept): cover counts, per crop pixel, the kept regions covering it. The
+    outer contour rasterizes to the component with its holes filled; each
+    hole (a 4-connected region of the complement not reaching the crop
+    border, nested blobs included) rasterizes to the hole dilated by one
+    pixel in the 4 directions.
+    """
+    n, holes = cv2.connectedComponents(np.pad(~comp, 1, constant_values=True).astype(np.uint8), connectivity=4)
+    holes[holes == holes[0, 0]] = 0  # exterior
+    padded_holes = holes
+    holes = holes[1:-1, 1:-1]
+
+    # (pixel, hole) pairs for component pixels 4-adjacent to a hole, each pair once
+    pix = np.flatnonzero(comp)
+    ys, xs = np.divmod(pix, comp.shape[1])
+    adj = np.stack([padded_holes[ys + 1 + dy, xs + 1 + dx] for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1))], 1)
+    ring = adj.any(1)
+    adj = np.sort(adj[ring], axis=1)
+    first = (adj != 0) & np.concatenate([np.ones((len(adj), 1), dtype=bool), adj[:, 1:] != adj[:, :-1]], 1)
+    ring_pix, ring_hole = np.repeat(pix[ring], first.sum(1)), adj[first]
+
+    hole_area = np.bincount(holes.ravel(), minlength=n)
+    hole_area[0] = 0
+    hole_ids = np.flatnonzero(hole_area)
+    kept_holes = np.zeros(n, dtype=bool)
+    kept_holes[hole_ids] = (hole_area + np.bincount(ring_hole, minlength=n))[hole_ids] >= th
+    outer_kept = len(pix) + hole_area.sum() >= th
+
+    cover = np.zeros(comp.shape, dtype=np.uint16)
+    if outer_kept:
+        cover[comp | (holes > 0)] += 1
+    cover[kept_holes[holes]] += 1
+    np.add.at(cover.ravel(), ring_pix[kept_holes[ring_hole]], 1)
+
+    return cover, 1 + len(hole_ids), int(outer_kept) + int(kept_holes.sum())
+
+
+def filter_components(img, th, connectivity=8):
+    """
+    Filter blobs by area with connected components, return rectified mask.
+
+    Reproduces filter_polygons_cv2 (counts and mask) without rasterizing a
+    full-image mask per contour. Blobs without holes are handled in one
+    connected-components pass. For blobs with holes every hole is counted as
+    a contour, as RETR_TREE does: a kept blob is filled, a kept hole covers
+    itself plus its border ring, and overlapping kept regions add up in
+    uint8 like the legacy mask (255 + 255 -> 254). connectivity=4 is an
+    approximation with plain component areas and no hole handling.
+    """
+    _, thresh = cv2.threshold(img, 150, 255, cv2.THRESH_BINARY)
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=connectivity)
+
+    keep = stats[:, cv2.CC_STAT_AREA] >= th
+    keep[0] = False  # background
+
+    with_holes = np.zeros(n, dtype=bool)
+    if connectivity == 8:
+        # Background not 4-connected to the image border lies in a hole of some blob
+        n_bg, bg = cv2.connectedComponents(cv2.bitwise_not(thresh), connectivity=4)
+        outside = np.zeros(n_bg, dtype=bool)
+        outside[0] = True
+        outside[np.concatenate([bg[0], bg[-1], bg[:, 0], bg[:, -1]])] = True
+        if not outside.all():
+            enclosed = ~outside[bg]
+            del bg
+            for lab in range(1, n):
+                x, y, w, h = stats[lab, :4]
+                with_holes[lab] = enclosed[y:y + h, x:x + w].any()
+
+    solid = keep & ~with_holes
+    maskr = np.where(solid, 255, 0).astype(np.uint8)[labels]
+    total, kept = n - 1 - int(with_holes.sum()), int(solid.sum())
+
+    if with_holes.any():
+        cover = np.zeros(img.shape, dtype=np.uint16)
+        for lab in np.flatnonzero(with_holes):
+            x, y, w, h = stats[lab, :4]
+            region_cover, t, k = _component_regions(labels[y:y + h, x:x + w] == lab, th)
+            cover[y:y + h, x:x + w] += region_cover
+            total += t
+            kept += k
+        maskr += (cover * 255).astype(np.uint8)  # wraps like the uint8 sums of filter_polygons_cv2
 
-    total_all, kept_all = 0, 0
-    for fname in sorted(os.listdir(input_dir)):
-        if not fname.endswith(ext):
-            continue
+    return maskr, total, kept
 
-        fpath = os.path.join(input_dir, fname)
-        img = cv2.imread(fpath, cv2.IMREAD_GRAYSCALE)
 
-        if img is None:
-            print(f"⚠️ Skipping {fname}, could not read")
-            continue
+def process_file(fpath, outpath, th, mode="cc"):
+    """Filter one mask file and save the rectified mask. Returns (total, kept), or None if unreadable."""
+    img = cv2.imread(fpath, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+
+    if mode == "cc":
+        maskr, total, kept = filter_components(img, th)
+    elif mode == "cv2":
+        maskr, total, kept = filter_polygons_cv2(img, th)
+    else:
+        maskr, total, kept = filter_polygons_skimage(img, th)
+
+    # Write under a temporary name so an interrupted run never leaves a
+    # truncated output that looks up to date
+    root, ext = os.path.splitext(outpath)
+    tmppath = f"{root}.part{ext}"
+    cv2.imwrite(tmppath, maskr)
+    os.replace(tmppath, outpath)
+    return total, kept
+
+
+def _is_up_to_date(fpath, outpath):
+    """True if outpath exists, is non-empty and is not older than fpath."""
+    try:
+        out = os.stat(outpath)
+    except FileNotFoundError:
+        return False
+    return out.st_size > 0 and out.st_mtime >= os.stat(fpath).st_mtime
+
 
-        if mode == "cv2":
-            maskr, total, kept = filter_polygons_cv2(img, th)
-        else:
-            maskr, total, kept = filter_polygons_skimage(img, th)
+COUNTS_FILE = "maskfilter_counts.json"
 
-        total_all += total
-        kept_all += kept
 
+def _load_counts(output_dir, th, mode):
+    """Per-file (total, kept) recorded by earlier runs with the same threshold and mode."""
+    try:
+        with open(os.path.join(output_dir, COUNTS_FILE)) as f:
+            saved = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if saved.get("th") != th or saved.get("mode") != mode:
+        return {}
+    return {fname: tuple(c) for fname, c in saved["files"].items()}
+
+
+def _save_counts(output_dir, th, mode, counts):
+    path = os.path.join(output_dir, COUNTS_FILE)
+    with open(f"{path}.part", "w") as f:
+        json.dump({"th": th, "mode": mode, "files": counts}, f)
+    os.replace(f"{path}.part", path)
+
+
+def _process_job(job):
+    fname, fpath, outpath, th, mode = job
+    return fname, process_file(fpath, outpath, th, mode)
+
+
+def process_dataset(input_dir, output_dir, th, mode="cc", ext=".png", workers=1, chunk_size=256, force=False):
+    """
+    Process all masks in dataset, save rectified ones.
+
+    Outputs that are already up to date (non-empty and newer than their input)
+    are skipped unless force is set, so an interrupted run can be resumed.
+    Per-file polygon counts are kept in maskfilter_counts.json in output_dir,
+    so the totals of a resumed run still cover the whole dataset; up-to-date
+    outputs without recorded counts (for this th and mode) are reprocessed.
+    With workers > 1 files are processed in chunks by a process pool.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    counts = _load_counts(output_dir, th, mode)
+
+    fnames = sorted(e.name for e in os.scandir(input_dir) if e.is_file() and e.name.endswith(ext))
+    jobs, skipped = [], []
+    for fname in fnames:
+        fpath = os.path.join(input_dir, fname)
         outpath = os.path.join(output_dir, fname)
-        cv2.imwrite(outpath, maskr)
+        if not force and fname in counts and _is_up_to_date(fpath, outpath):
+            skipped.append(fname)
+            continue
+        counts.pop(fname, None)
+        jobs.append((fname, fpath, outpath, th, mode))
+
+    print(f"Found {len(fnames)} masks, {len(skipped)} up to date, {len(jobs)} to process")
 
-    print(f"✅ Finished. Polygons found: {total_all}, kept: {kept_all}, dropped: {total_all - kept_all}")
+    total_all = sum(counts[fname][0] for fname in skipped)
+    kept_all = sum(counts[fname][1] for fname in skipped)
+    done = 0
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(_process_job, jobs, chunksize=max(1, chunk_size // workers))
+    else:
+        pool = None
+        results = map(_process_job, jobs)
+
+    try:
+        for fname, file_counts in results:
+            done += 1
+            metrics.count(tiles=1)
+            if file_counts is None:
+                print(f"⚠️ Skipping {fname}, could not read")
+            else:
+                counts[fname] = file_counts
+                total_all += file_counts[0]
+                kept_all += file_counts[1]
+            if done % chunk_size == 0:
+                _save_counts(output_dir, th, mode, counts)
+                print(f"[{done}/{len(jobs)}] Polygons found: {total_all}, kept: {kept_all}, "
+                      f"dropped: {total_all - kept_all}", flush=True)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        _save_counts(output_dir, th, mode, counts)
+
+    print(f"✅ Finished. Polygons found: {total_all}, kept: {kept_all}, dropped: {total_all - kept_all} "
+          f"({done} files processed, {len(skipped)} up to date)")
 
 
 def main():
@@ -102,12 +283,21 @@ def main():
     parser.add_argument("-i", "--input-dir", required=True, help="Input directory containing masks")
     parser.add_argument("-o", "--output-dir", required=True, help="Output directory for rectified masks")
     parser.add_argument("-t", "--th", type=int, default=900, help="Area threshold in pixels")
-    parser.add_argument("--mode", choices=["cv2", "skimage"], default="cv2",
-                        help="Polygon detection backend (cv2 contours or skimage find_contours)")
+    parser.add_argument("--mode", choices=["cc", "cv2", "skimage"], default="cc",
+                        help="Polygon detection backend (connected components, cv2 contours "
+                             "or skimage find_contours)")
     parser.add_argument("--ext", default=".png", help="File extension filter (default: .png)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes (default: 1)")
+    parser.add_argument("--chunk-size", type=int, default=256,
+                        help="Files per chunk; counters are reported after each chunk (default: 256)")
+    parser.add_argument("--force", action="store_true", help="Reprocess files whose output is up to date")
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
-    process_dataset(args.input_dir, args.output_dir, args.th, mode=args.mode, ext=args.ext)
+    metrics.setup(args, "maskfilter")
+    with metrics.stage(f"process_dataset_{args.mode}"):
+        process_dataset(args.input_dir, args.output_dir, args.th, mode=args.mode, ext=args.ext,
+                        workers=args.workers, chunk_size=args.chunk_size, force=args.force)
 
 
 if __name__ == "__main__":
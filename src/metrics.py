@@ -0,0 +1,179 @@
+"""
+Shared instrumentation for the CLI scripts.
+
+Stages are timed with the `stage` context manager; code inside a stage
+reports how much work it did with `count(pixels=..., tiles=...)`. When a
+metrics file is configured (--metrics), every stage appends one JSON line:
+
+    {"ts": ..., "pid": ..., "script": "split", "stage": "split_images",
+     "wall_s": 2.1, "pixels": 16777216, "mpix_s": 7.9, "tiles": 256,
+     "tiles_s": 121.9, "rss_mb": 240.3, "peak_rss_mb": 259.0}
+
+plus a final "total" line per run, timed from configure() so start-up and
+imports are not included. peak_rss_mb is sampled by a background thread
+for the duration of the stage. --profile writes cProfile stats for the
+whole run. For py-spy, the main thread is renamed "stage:<name>" while a
+stage runs, so `py-spy dump` / `py-spy record --threads` show it.
+
+Without --metrics, stages only keep their timers and counters, so the
+calls can stay in library code.
+"""
+import atexit
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+_sink = None
+_script = None
+_stack = []
+_lock = threading.Lock()
+
+try:
+    _PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 2**20
+except (AttributeError, ValueError, OSError):
+    _PAGE_MB = None
+
+
+def rss_mb():
+    """Current resident set size in MB (peak RSS where /proc is not available)."""
+    if _PAGE_MB is not None:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * _PAGE_MB
+        except OSError:
+            pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PeakMemorySampler:
+    """Sample RSS every `interval` seconds in a daemon thread and keep the maximum."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, rss_mb())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, rss_mb())
+
+
+class Stage:
+    """Timer and work counters of one running stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pixels = 0
+        self.tiles = 0
+        self.start = time.perf_counter()
+        self.wall_s = None
+
+    def count(self, pixels=0, tiles=0):
+        self.pixels += pixels
+        self.tiles += tiles
+
+    def record(self):
+        wall = self.wall_s if self.wall_s is not None else time.perf_counter() - self.start
+        rec = {"stage": self.name, "wall_s": round(wall, 6)}
+        if self.pixels:
+            rec["pixels"] = self.pixels
+            rec["mpix_s"] = round(self.pixels / wall / 1e6, 3) if wall > 0 else None
+        if self.tiles:
+            rec["tiles"] = self.tiles
+            rec["tiles_s"] = round(self.tiles / wall, 3) if wall > 0 else None
+        return rec
+
+
+def emit(record):
+    """Append one record to the metrics file, if one is configured."""
+    if _sink is None:
+        return
+    line = json.dumps({"ts": round(time.time(), 3), "pid": os.getpid(), "script": _script, **record})
+    with _lock:
+        _sink.write(line + "\n")
+        _sink.flush()
+
+
+@contextmanager
+def stage(name, pixels=0, tiles=0):
+    """Time a block as stage `name`; pixels/tiles can be given up front or added with count()."""
+    s = Stage(name)
+    s.count(pixels, tiles)
+    _stack.append(s)
+    thread = threading.current_thread()
+    thread_name, thread.name = thread.name, f"stage:{name}"
+    sampler = PeakMemorySampler() if _sink is not None else None
+    try:
+        if sampler is None:
+            yield s
+        else:
+            with sampler:
+                yield s
+    finally:
+        s.wall_s = time.perf_counter() - s.start
+        thread.name = thread_name
+        _stack.remove(s)
+        if sampler is not None:
+            emit({**s.record(), "rss_mb": round(rss_mb(), 1), "peak_rss_mb": round(sampler.peak_mb, 1)})
+
+
+def count(pixels=0, tiles=0):
+    """Add work to the innermost running stage (no-op outside a stage)."""
+    if _stack:
+        _stack[-1].count(pixels, tiles)
+
+
+def configure(path=None, profile=None, script=None):
+    """
+    Start recording: JSON-lines metrics to `path` (appended) and/or cProfile
+    stats to `profile`. A "total" record and the profile are written at exit.
+    """
+    global _sink, _script
+    _script = script
+    start = time.perf_counter()
+    if path:
+        _sink = open(path, "a")
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        global _sink
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if _sink is not None:
+            rss = rss_mb()
+            peak = max(rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+            emit({"stage": "total", "wall_s": round(time.perf_counter() - start, 6), "rss_mb": round(rss, 1),
+                  "peak_rss_mb": round(peak, 1)})
+            _sink.close()
+            _sink = None
+
+    atexit.register(finish)
+
+
+def add_arguments(parser):
+    """Add the --metrics and --profile options to a script's argument parser."""
+    parser.add_argument("--metrics", default=None, help="Append JSON-lines stage metrics to this file")
+    parser.add_argument("--profile", default=None, help="Write cProfile stats for the run to this file")
+
+
+def setup(args, script):
+    """configure() from the parsed --metrics/--profile options."""
+    configure(args.metrics, args.profile, script)
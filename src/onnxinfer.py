@@ -0,0 +1,209 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+import metrics
+from inference import count_patches, iter_batches, load_model, predict, to_tensor
+
+
+class OnnxChangeModel:
+    """
+    ONNX Runtime session with the model(before, after) call signature of the
+    TorchScript model, so it can be used anywhere inference.load_model is.
+    """
+
+    def __init__(self, path, intra_op_threads=None, inter_op_threads=None):
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.intra_op_num_threads = intra_op_threads or os.cpu_count()
+        if inter_op_threads and inter_op_threads > 1:
+            opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            opts.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def eval(self):
+        return self
+
+    def __call__(self, before, after):
+        feeds = {name: np.asarray(x, dtype=np.float32) for name, x in zip(self.input_names, (before, after))}
+        return self.session.run(None, feeds)[0]
+
+
+class PatchCalibrationReader(CalibrationDataReader):
+    """Feed before/after batches from split.py patches to static quantization calibration."""
+
+    def __init__(self, patch_dir, input_names, count=512, batch_size=16):
+        total = min(count, count_patches(patch_dir))
+        self.input_names = input_names
+        self._batches = iter_batches(patch_dir, total, batch_size)
+
+    def get_next(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            return None
+        _, before, after = batch
+        return {name: to_tensor(x).numpy() for name, x in zip(self.input_names, (before, after))}
+
+
+def export_onnx(model_path, onnx_path, patch_size=256, opset=17):
+    """Export a TorchScript (or the dummy) change detection model to ONNX with a dynamic batch axis."""
+    model = load_model(model_path)
+    os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+    example = torch.rand(1, 3, patch_size, patch_size)
+    torch.onnx.export(
+        model, (example, example), onnx_path,
+        input_names=["before", "after"], output_names=["output"],
+        dynamic_axes={name: {0: "batch"} for name in ("before", "after", "output")},
+        opset_version=opset, dynamo=False,
+    )
+    print(f"✅ Exported {model_path} to {onnx_path}")
+
+
+def quantize_model(onnx_path, output_path, mode="dynamic", patch_dir=None, calib_patches=512, batch_size=16):
+    """
+    Quantize an ONNX model to int8.
+
+    "dynamic" quantizes weights ahead of time and activations on the fly;
+    convolutions become ConvInteger, which is often slower than float on
+    CPU, so it mainly suits MatMul-heavy models. "static" also fixes the
+    activation ranges, calibrated (MinMax) on the first calib_patches
+    before/after patches from split.py, and writes a QDQ model with
+    per-channel int8 weights and uint8 activations.
+    """
+    if mode not in ("dynamic", "static"):
+        raise ValueError(f"Unknown quantization mode '{mode}'")
+    if mode == "static" and patch_dir is None:
+        raise ValueError("Static quantization needs split.py patches for calibration")
+
+    t0 = time.perf_counter()
+    prep_path = f"{output_path}.prep.onnx"
+    quant_pre_process(onnx_path, prep_path)  # shape inference + graph optimization
+    try:
+        if mode == "dynamic":
+            quantize_dynamic(prep_path, output_path, weight_type=QuantType.QInt8)
+        else:
+            session = ort.InferenceSession(prep_path, providers=["CPUExecutionProvider"])
+            input_names = [i.name for i in session.get_inputs()]
+            reader = PatchCalibrationReader(patch_dir, input_names, calib_patches, batch_size)
+            quantize_static(prep_path, output_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    finally:
+        os.remove(prep_path)
+    print(f"✅ {mode.capitalize()} int8 model saved: {output_path} in {time.perf_counter() - t0:.2f}s "
+          f"({os.path.getsize(onnx_path) / 1e6:.2f} MB -> {os.path.getsize(output_path) / 1e6:.2f} MB)")
+
+
+def compare_backends(models, patch_dir, count=512, batch_size=16):
+    """
+    Run every model on the same patches and report latency and accuracy.
+
+    The first model is the reference (float PyTorch): the others report the
+    fraction of mask pixels that agree with it. All models report IoU
+    against the label patches. The first batch is a warm-up and not timed.
+
+    Args:
+        models (dict): Name -> model called as model(before, after).
+        patch_dir (str): split.py output directory with A, B and label patches.
+
+    Returns:
+        dict: Name -> {"ms_per_tile", "tiles_per_s", "agreement", "iou"}.
+    """
+    total = min(count, count_patches(patch_dir))
+    batches = list(iter_batches(patch_dir, total, batch_size, subsets=("A", "B", "label")))
+    ref_name = next(iter(models))
+
+    results, ref_masks = {}, None
+    for name, model in models.items():
+        _, before, after, _ = batches[0]
+        predict(model, before, after)  # warm-up
+
+        elapsed, masks, inter, union = 0.0, [], 0, 0
+        with metrics.stage(f"predict:{name}") as s:
+            for _, before, after, label in batches:
+                t0 = time.perf_counter()
+                pred = predict(model, before, after) > 0
+                elapsed += time.perf_counter() - t0
+                truth = label > 0
+                if truth.ndim == 4:
+                    truth = truth.any(-1)
+                inter += np.count_nonzero(pred & truth)
+                union += np.count_nonzero(pred | truth)
+                masks.append(pred)
+                s.count(pixels=pred.size, tiles=len(pred))
+
+        masks = np.concatenate(masks)
+        if ref_masks is None:
+            ref_masks = masks
+        results[name] = {
+            "ms_per_tile": 1000 * elapsed / total,
+            "tiles_per_s": total / elapsed,
+            "agreement": float(np.mean(masks == ref_masks)),
+            "iou": inter / union if union else 1.0,
+        }
+
+    ref_ms = results[ref_name]["ms_per_tile"]
+    print(f"\nLatency and accuracy on {total} patches (batch {batch_size}, reference: {ref_name})")
+    print(f"{'backend':<20}{'ms/tile':>10}{'tiles/s':>10}{'speedup':>10}{'agree':>10}{'IoU':>8}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['ms_per_tile']:>10.2f}{r['tiles_per_s']:>10.1f}{ref_ms / r['ms_per_tile']:>9.2f}x"
+              f"{r['agreement']:>10.4f}{r['iou']:>8.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the change detection model to quantized ONNX and compare it "
+                                                 "with the float PyTorch model")
+    parser.add_argument("-m", "--model", required=True, help="TorchScript model path, or 'dummy'")
+    parser.add_argument("-o", "--output", required=True, help="ONNX output path (int8 model is saved as *.int8.onnx)")
+    parser.add_argument("-i", "--input_dir", help="split.py output directory, for calibration and the comparison")
+    parser.add_argument("--quantize", choices=["none", "dynamic", "static"], default=None,
+                        help="int8 quantization mode; dynamic is usually slower than fp32 for conv nets "
+                             "(default: static with --input_dir, otherwise none)")
+    parser.add_argument("--patch_size", type=int, default=256, help="Patch size (default=256)")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset (default=17)")
+    parser.add_argument("--calib_patches", type=int, default=512, help="Patches for static calibration (default=512)")
+    parser.add_argument("--eval_patches", type=int, default=512, help="Patches for the comparison, 0 skips it "
+                                                                      "(default=512)")
+    parser.add_argument("--batch_size", type=int, default=16, help="Patches per forward pass (default=16)")
+    parser.add_argument("--intra_op_threads", type=int, default=None, help="Intra-op threads (default: all CPUs)")
+    parser.add_argument("--inter_op_threads", type=int, default=None,
+                        help="ONNX Runtime inter-op threads; > 1 enables parallel execution (default: sequential)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args, "onnxinfer")
+
+    if args.quantize is None:
+        args.quantize = "static" if args.input_dir else "none"
+    if args.quantize == "static" and not args.input_dir:
+        parser.error("--quantize static needs --input_dir for calibration")
+
+    with metrics.stage("export_onnx"):
+        export_onnx(args.model, args.output, args.patch_size, args.opset)
+    quantized = None
+    if args.quantize != "none":
+        quantized = f"{os.path.splitext(args.output)[0]}.int8.onnx"
+        with metrics.stage(f"quantize_{args.quantize}"):
+            quantize_model(args.output, quantized, args.quantize, args.input_dir, args.calib_patches,
+                           args.batch_size)
+
+    if args.input_dir and args.eval_patches > 0:
+        torch.set_num_threads(args.intra_op_threads or os.cpu_count())
+        models = {
+            "torch-fp32": load_model(args.model),
+            "onnx-fp32": OnnxChangeModel(args.output, args.intra_op_threads, args.inter_op_threads),
+        }
+        if quantized:
+            models[f"onnx-int8-{args.quantize}"] = OnnxChangeModel(quantized, args.intra_op_threads,
+                                                                  args.inter_op_threads)
+        compare_backends(models, args.input_dir, args.eval_patches, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import cv2
+import numpy as np
+import pyproj
+import rasterio
+from skimage.exposure import match_histograms
+
+import metrics
+from image_reg_msecalc import apply_shift, find_best_shift, find_shift_phase, find_shift_pyramid
+from maskfilter import filter_components
+from pngconv import percentile_lut
+from reversegeocode import OfflineGeocoder, export_polygons, geocode_centroids, georeference_polygons
+
+
+def file_key(path):
+    """SHA-256 of a file's content."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class StageCache:
+    """
+    Cache of stage outputs keyed by a hash of the stage name, its parameters
+    and the keys of its inputs.
+
+    Keys chain through the pipeline, so changing one stage's parameters
+    changes its key and the keys of every stage after it, while the stages
+    before it are loaded from the cache.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def run(self, name, fn, inputs, input_keys, **params):
+        key = hashlib.sha256(json.dumps(
+            {"stage": name, "params": params, "inputs": input_keys}, sort_keys=True, default=str
+        ).encode()).hexdigest()
+
+        path = os.path.join(self.cache_dir, f"{name}-{key[:20]}.pkl") if self.cache_dir else None
+        if path and os.path.exists(path):
+            with metrics.stage(f"{name}:cached"), open(path, "rb") as f:
+                output = pickle.load(f)
+            print(f"[{name}] cached ({key[:12]})")
+            return output, key
+
+        t0 = time.perf_counter()
+        with metrics.stage(name):
+            output = fn(*inputs, **params)
+        print(f"[{name}] {time.perf_counter() - t0:.2f}s ({key[:12]})")
+
+        if path:
+            tmp = f"{path}.part"
+            with open(tmp, "wb") as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        return output, key
+
+
+def to_8bit(img, low=0.5, high=99.5):
+    """Grayscale uint8 view of an image; 16-bit data gets a percentile stretch."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.dtype == np.uint8:
+        return img
+    if img.dtype != np.uint16:
+        raise ValueError(f"Unsupported dtype {img.dtype}")
+    lut = percentile_lut(np.bincount(img.ravel(), minlength=65536), 0, low, high)
+    return lut[img]
+
+
+def stage_load(before_path, after_path):
+    before = cv2.imread(before_path, cv2.IMREAD_UNCHANGED)
+    after = cv2.imread(after_path, cv2.IMREAD_UNCHANGED)
+    if before is None or after is None:
+        raise FileNotFoundError("Could not read one or both images")
+    metrics.count(pixels=before.shape[0] * before.shape[1])
+    return to_8bit(before), to_8bit(after)
+
+
+def stage_enhance(images, method="equalize"):
+    before, after = images
+    metrics.count(pixels=before.size)
+    if method == "equalize":
+        return cv2.equalizeHist(before), cv2.equalizeHist(after)
+    if method == "match":
+        matched = np.clip(np.rint(match_histograms(after, before)), 0, 255).astype(np.uint8)
+        return before, matched
+    return before, after
+
+
+def stage_register(images, method="phase", start_x=None, start_y=None, wsize=None, shift=20):
+    before, after = images
+    h, w = before.shape
+    metrics.count(pixels=h * w)
+    # Default to a centred window over half the scene
+    wsize = wsize or min(h, w) // 2
+    start_x = (w - wsize) // 2 if start_x is None else start_x
+    start_y = (h - wsize) // 2 if start_y is None else start_y
+
+    if method == "phase":
+        (dx, dy), error = find_shift_phase(before, after, start_x, start_y, wsize)
+    elif method == "pyramid":
+        (dx, dy), error = find_shift_pyramid(before, after, start_x, start_y, wsize, shift)
+    elif method == "mse":
+        (dx, dy), error = find_best_shift(before, after, start_x, start_y, wsize, shift)
+    else:
+        return before, after
+    print(f"[register] dx={dx:.2f}, dy={dy:.2f}, MSE={error:.3f}")
+    return before, apply_shift(after, dx, dy)
+
+
+def stage_infer(images, model_path, patch_size=256, batch_size=16):
+    """Run a TorchScript change-detection model over all full tiles, return a 0/255 mask."""
+    from inference import load_model, predict  # torch is only needed for this stage
+
+    before, after = images
+    model = load_model(model_path)
+    h, w = before.shape
+    mask = np.zeros((h, w), dtype=np.uint8)
+    origins = [(y, x) for y in range(0, h - patch_size + 1, patch_size)
+               for x in range(0, w - patch_size + 1, patch_size)]
+
+    def tiles(img, batch):
+        return np.stack([img[y:y + patch_size, x:x + patch_size] for y, x in batch])
+
+    for i in range(0, len(origins), batch_size):
+        batch = origins[i:i + batch_size]
+        for (y, x), m in zip(batch, predict(model, tiles(before, batch), tiles(after, batch))):
+            mask[y:y + patch_size, x:x + patch_size] = m
+        metrics.count(pixels=len(batch) * patch_size * patch_size, tiles=len(batch))
+    return mask
+
+
+def stage_filter(mask, th=900):
+    maskr, total, kept = filter_components(mask, th)
+    metrics.count(pixels=mask.size)
+    print(f"[filter] components: {total}, kept: {kept}, dropped: {total - kept}")
+    return maskr
+
+
+def stage_polygons(mask):
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    metrics.count(pixels=mask.size, tiles=len(contours))
+    return [c[:, 0, :].tolist() for c in contours]
+
+
+def write_mask_geotiff(mask, reference_tif, output_tif):
+    with rasterio.open(reference_tif) as ref:
+        crs, transform = ref.crs, ref.transform
+    with rasterio.open(output_tif, "w", driver="GTiff", count=1, height=mask.shape[0], width=mask.shape[1],
+                       dtype="uint8", crs=crs, transform=transform, tiled=True, compress="deflate") as dst:
+        dst.write(mask, 1)
+    print(f"✅ GeoTIFF written: {output_tif}")
+
+
+def run_pipeline(args):
+    """Run all stages in-process on arrays, caching each stage's output."""
+    cache_dir = os.path.join(args.output_dir, ".pipeline_cache") if args.cache_dir is None else args.cache_dir
+    cache = StageCache(cache_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.prediction:
+        pred = cv2.imread(args.prediction, cv2.IMREAD_GRAYSCALE)
+        if pred is None:
+            raise FileNotFoundError(f"Could not read {args.prediction}")
+        mask, key = pred, file_key(args.prediction)
+    else:
+        images, key = cache.run("load", stage_load, (args.before, args.after),
+                                [file_key(args.before), file_key(args.after)])
+        images, key = cache.run("enhance", stage_enhance, (images,), [key], method=args.enhance)
+        images, key = cache.run("register", stage_register, (images,), [key], method=args.register,
+                                start_x=args.start_x, start_y=args.start_y, wsize=args.wsize, shift=args.shift)
+        model_key = args.model if args.model == "dummy" else file_key(args.model)
+        mask, key = cache.run("infer", stage_infer, (images,), [key, model_key],
+                              model_path=args.model, patch_size=args.patch_size, batch_size=args.batch_size)
+
+    mask, key = cache.run("filter", stage_filter, (mask,), [key], th=args.th)
+    polygons, key = cache.run("polygons", stage_polygons, (mask,), [key])
+    print(f"Found {len(polygons)} change polygons")
+
+    with metrics.stage("export", pixels=mask.size, tiles=len(polygons)):
+        cv2.imwrite(os.path.join(args.output_dir, "changes.png"), mask)
+        if args.reference:
+            write_mask_geotiff(mask, args.reference, os.path.join(args.output_dir, "changes.tif"))
+            transformer = pyproj.Transformer.from_crs(f"epsg:{args.epsg_in}", f"epsg:{args.epsg_out}",
+                                                      always_xy=True)
+            with rasterio.open(args.reference) as ref:
+                rings, centroids, areas = georeference_polygons(polygons, ref.transform, transformer)
+            geocodes = None
+            if args.gazetteer:
+                geocodes = geocode_centroids(centroids, gazetteer=OfflineGeocoder(args.gazetteer))
+            export_polygons(os.path.join(args.output_dir, f"changes.{args.vector_format}"),
+                            rings, centroids, areas, args.epsg_out, geocodes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the change detection pipeline in-process with a stage cache")
+    parser.add_argument("--before", help="Before image (PNG/TIFF, 8 or 16 bit)")
+    parser.add_argument("--after", help="After image (PNG/TIFF, 8 or 16 bit)")
+    parser.add_argument("--model", help="TorchScript or .onnx change detection model called as model(before, after), "
+                                        "or 'dummy'")
+    parser.add_argument("--prediction", help="Precomputed change mask; skips load/enhance/register/infer")
+    parser.add_argument("-o", "--output_dir", required=True, help="Output directory")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Stage cache directory ('' disables caching, default: OUTPUT_DIR/.pipeline_cache)")
+    parser.add_argument("--enhance", choices=["equalize", "match", "none"], default="equalize",
+                        help="Radiometric step: histogram equalization, match after to before, or none")
+    parser.add_argument("--register", choices=["phase", "pyramid", "mse", "none"], default="phase",
+                        help="Registration method (see image_reg_msecalc.py)")
+    parser.add_argument("--start_x", type=int, default=None, help="Registration window x (default: centred)")
+    parser.add_argument("--start_y", type=int, default=None, help="Registration window y (default: centred)")
+    parser.add_argument("--wsize", type=int, default=None, help="Registration window size (default: half the scene)")
+    parser.add_argument("--shift", type=int, default=20, help="Shift range for mse/pyramid registration")
+    parser.add_argument("--patch_size", type=int, default=256, help="Inference tile size (default: 256)")
+    parser.add_argument("--batch_size", type=int, default=16, help="Inference batch size (default: 16)")
+    parser.add_argument("-t", "--th", type=int, default=900, help="Area threshold in pixels")
+    parser.add_argument("-r", "--reference", help="Reference GeoTIFF; enables GeoTIFF and vector outputs")
+    parser.add_argument("--epsg_in", default="32643", help="Input projection EPSG (default: 32643)")
+    parser.add_argument("--epsg_out", default="4326", help="Output projection EPSG (default: 4326)")
+    parser.add_argument("--vector_format", choices=["gpkg", "geojson"], default="gpkg", help="Vector output format")
+    parser.add_argument("--gazetteer", help="Offline gazetteer CSV for geocoding polygon centroids")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args, "pipeline")
+
+    if not args.prediction and not (args.before and args.after and args.model):
+        parser.error("either --prediction or --before, --after and --model are required")
+
+    run_pipeline(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 import argparse
 import rasterio as rio
+import rasterio.shutil
 from rasterio.enums import Resampling
+from rasterio.warp import calculate_default_transform, reproject
+from rasterio.windows import Window
 import numpy as np
 import os
+import time
+
+import metrics
 
 
 def png_to_geotiff(png_path, reference_tif, output_tif, dtype="uint16"):
@@ -19,6 +25,7 @@ def png_to_geotiff(png_path, reference_tif, output_tif, dtype="uint16"):
     with rio.open(png_path) as src:
         img = src.read([1])  # read first band only
         img = img.astype(dtype)
+        metrics.count(pixels=img.shape[1] * img.shape[2])
         print(f"PNG loaded: {png_path}, shape={img.shape}, dtype={img.dtype}")
 
     # Reference GeoTIFF
@@ -46,40 +53,131 @@ def png_to_geotiff(png_path, reference_tif, output_tif, dtype="uint16"):
     print(f"✅ GeoTIFF written: {output_tif}")
 
 
-def resample_to_reference(input_tif, reference_tif, output_tif, resampling=Resampling.nearest):
+def png_to_cog(png_path, reference_tif, output_tif, dtype="uint16", compress="deflate", blocksize=512,
+               overview_resampling="nearest"):
     """
-    Resample a GeoTIFF so it aligns with reference (pixels overlap).
-    Useful when dataset grids differ.
+    Convert PNG to a Cloud-Optimized GeoTIFF (tiled, compressed, with overviews).
+
+    The PNG is copied strip by strip into a temporary tiled GeoTIFF, which
+    GDAL's COG driver then rewrites with internal overviews, so memory stays
+    bounded by one strip of blocksize rows.
+
+    Args:
+        png_path (str): Input PNG image path
+        reference_tif (str): Reference GeoTIFF with CRS + transform
+        output_tif (str): Output COG file path
+        dtype (str): Output data type (default: uint16)
+        compress (str): COG compression, e.g. deflate, zstd, lzw (default: deflate)
+        blocksize (int): Internal tile size (default: 512)
+        overview_resampling (str): Overview resampling, nearest for masks, average for imagery
     """
-    with rio.open(reference_tif) as ref:
-        with rio.open(input_tif) as src:
-            data = src.read(
-                out_shape=(
-                    src.count,
-                    ref.height,
-                    ref.width
-                ),
-                resampling=resampling
-            )
-            transform = ref.transform
-            print(f"Resampled shape: {data.shape}")
-
-            with rio.open(
-                output_tif,
-                "w",
-                driver="GTiff",
-                count=data.shape[0],
-                height=data.shape[1],
-                width=data.shape[2],
-                dtype=data.dtype,
-                crs=ref.crs,
-                transform=transform,
-            ) as dst:
-                dst.write(data)
+    os.makedirs(os.path.dirname(output_tif) or ".", exist_ok=True)
+    tmp_tif = f"{os.path.splitext(output_tif)[0]}.tmp.tif"
+
+    with rio.open(png_path) as src, rio.open(reference_tif) as ref:
+        print(f"PNG opened: {png_path}, shape={src.shape}, reference CRS: {ref.crs}")
+        metrics.count(pixels=src.height * src.width)
+        with rio.open(
+            tmp_tif,
+            "w",
+            driver="GTiff",
+            count=1,
+            height=src.height,
+            width=src.width,
+            dtype=dtype,
+            crs=ref.crs,
+            transform=ref.transform,
+            tiled=True,
+            blockxsize=blocksize,
+            blockysize=blocksize,
+            BIGTIFF="IF_SAFER",
+        ) as dst:
+            for y in range(0, src.height, blocksize):
+                window = Window(0, y, src.width, min(blocksize, src.height - y))
+                dst.write(src.read(1, window=window).astype(dtype), 1, window=window)
+
+    try:
+        rasterio.shutil.copy(
+            tmp_tif,
+            output_tif,
+            driver="COG",
+            COMPRESS=compress.upper(),
+            BLOCKSIZE=blocksize,
+            OVERVIEWS="AUTO",
+            RESAMPLING=overview_resampling.upper(),
+            BIGTIFF="IF_SAFER",
+            NUM_THREADS="ALL_CPUS",
+        )
+    finally:
+        os.remove(tmp_tif)
+
+    print(f"✅ COG written: {output_tif}")
+
+
+def _warp_bands(src, dst, resampling, num_threads, warp_mem_limit):
+    """Warp every band of src into dst; GDAL processes output chunks in parallel and writes them to disk."""
+    for band in range(1, src.count + 1):
+        reproject(
+            source=rio.band(src, band),
+            destination=rio.band(dst, band),
+            resampling=resampling,
+            num_threads=num_threads or os.cpu_count(),
+            warp_mem_limit=warp_mem_limit,
+        )
+
+
+def _warp_profile(src, crs, transform, width, height):
+    return {
+        "driver": "GTiff",
+        "count": src.count,
+        "height": height,
+        "width": width,
+        "dtype": src.dtypes[0],
+        "nodata": src.nodata,
+        "crs": crs,
+        "transform": transform,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "BIGTIFF": "IF_SAFER",
+    }
+
+
+def resample_to_reference(input_tif, reference_tif, output_tif, resampling=Resampling.nearest, num_threads=None,
+                          warp_mem_limit=256):
+    """
+    Reproject a GeoTIFF onto the reference grid (CRS, transform and size), so pixels overlap.
+    Useful when dataset grids or CRSs differ.
+
+    The warp runs window by window straight into the output file, so memory is
+    bounded by warp_mem_limit (MB) rather than the scene size.
+    """
+    with rio.open(reference_tif) as ref, rio.open(input_tif) as src:
+        if src.crs != ref.crs:
+            print(f"Reprojecting {src.crs} -> {ref.crs}")
+        profile = _warp_profile(src, ref.crs, ref.transform, ref.width, ref.height)
+        metrics.count(pixels=ref.height * ref.width)
+        with rio.open(output_tif, "w", **profile) as dst:
+            _warp_bands(src, dst, resampling, num_threads, warp_mem_limit)
+        print(f"Resampled shape: {(src.count, ref.height, ref.width)}")
 
     print(f"✅ Resampled GeoTIFF written: {output_tif}")
 
 
+def reproject_to_crs(input_tif, output_tif, dst_crs="EPSG:3857", resampling=Resampling.nearest, num_threads=None,
+                     warp_mem_limit=256):
+    """Reproject a GeoTIFF to another CRS, choosing the output grid like gdalwarp does."""
+    with rio.open(input_tif) as src:
+        transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+        profile = _warp_profile(src, dst_crs, transform, width, height)
+        metrics.count(pixels=height * width)
+        os.makedirs(os.path.dirname(output_tif) or ".", exist_ok=True)
+        with rio.open(output_tif, "w", **profile) as dst:
+            _warp_bands(src, dst, resampling, num_threads, warp_mem_limit)
+
+    print(f"✅ Reprojected GeoTIFF written: {output_tif}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Convert PNG to GeoTIFF using reference TIFF georeferencing.")
     parser.add_argument("-p", "--png", required=True, help="Input PNG file")
@@ -87,13 +185,45 @@ def main():
     parser.add_argument("-o", "--output", required=True, help="Output GeoTIFF file")
     parser.add_argument("--dtype", default="uint16", help="Output datatype (default: uint16)")
     parser.add_argument("--resample", action="store_true", help="Also resample PNG GeoTIFF to match reference grid")
+    parser.add_argument("--cog", action="store_true",
+                        help="Write a Cloud-Optimized GeoTIFF (tiled, compressed, with overviews)")
+    parser.add_argument("--compress", default="deflate", help="COG compression: deflate, zstd, lzw... (default: deflate)")
+    parser.add_argument("--blocksize", type=int, default=512, help="COG internal tile size (default: 512)")
+    parser.add_argument("--overview_resampling", default="nearest",
+                        help="COG overview resampling (default: nearest; use average for imagery)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Warp threads for --resample (default: all CPUs)")
+    parser.add_argument("--compare", action="store_true",
+                        help="With --cog, also write the plain GeoTIFF and report write time and size of both")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-
-    png_to_geotiff(args.png, args.reference, args.output, args.dtype)
+    metrics.setup(args, "png2georef")
+
+    if args.cog:
+        t0 = time.perf_counter()
+        with metrics.stage("png_to_cog"):
+            png_to_cog(args.png, args.reference, args.output, args.dtype, args.compress, args.blocksize,
+                       args.overview_resampling)
+        cog_time, cog_size = time.perf_counter() - t0, os.path.getsize(args.output)
+        print(f"COG: {cog_time:.2f}s, {cog_size / 2**20:.2f} MiB")
+
+        if args.compare:
+            plain_path = args.output.replace(".tif", "_plain.tif")
+            t0 = time.perf_counter()
+            with metrics.stage("png_to_geotiff"):
+                png_to_geotiff(args.png, args.reference, plain_path, args.dtype)
+            plain_time, plain_size = time.perf_counter() - t0, os.path.getsize(plain_path)
+            print(f"Plain GeoTIFF: {plain_time:.2f}s, {plain_size / 2**20:.2f} MiB")
+            print(f"COG vs plain: {cog_time / plain_time:.2f}x write time, {cog_size / plain_size:.2%} of the size")
+            os.remove(plain_path)
+    else:
+        with metrics.stage("png_to_geotiff"):
+            png_to_geotiff(args.png, args.reference, args.output, args.dtype)
 
     if args.resample:
         resample_path = args.output.replace(".tif", "_resampled.tif")
-        resample_to_reference(args.output, args.reference, resample_path)
+        with metrics.stage("resample_to_reference"):
+            resample_to_reference(args.output, args.reference, resample_path, num_threads=args.threads)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,13 @@ import cv2
 import numpy as np
 import argparse
 import os
+import rasterio
+import rasterio.shutil
+import warnings
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+
+import metrics
 
 def convert_tif_to_png(input_path, output_path, is_mask=False, scale_to_8bit=True):
     """Convert TIFF to PNG. Handles both masks and images."""
@@ -25,6 +32,88 @@ def convert_tif_to_png(input_path, output_path, is_mask=False, scale_to_8bit=Tru
             img = img.astype('uint8')
 
     cv2.imwrite(output_path, img)
+    metrics.count(pixels=img.shape[0] * img.shape[1])
+    print(f"Saved: {output_path}")
+
+
+def _strips(src, block_rows):
+    for y in range(0, src.height, block_rows):
+        yield Window(0, y, src.width, min(block_rows, src.height - y))
+
+
+def percentile_lut(hist, offset, low=0.5, high=99.5):
+    """Build a uint8 LUT stretching the [low, high] percentiles of hist to [0, 255]."""
+    cdf = np.cumsum(hist, dtype=np.float64)
+    if cdf[-1] == 0:
+        return np.zeros(len(hist), dtype=np.uint8)
+    cdf /= cdf[-1]
+    lo = np.searchsorted(cdf, low / 100)
+    hi = max(np.searchsorted(cdf, high / 100), lo + 1)
+    print(f"Stretch: p{low}={lo + offset}, p{high}={hi + offset}")
+    ramp = (np.arange(len(hist), dtype=np.float32) - lo) * (255.0 / (hi - lo))
+    return np.clip(np.rint(ramp), 0, 255).astype(np.uint8)
+
+
+def convert_tif_to_png_blockwise(input_path, output_path, is_mask=False, low=0.5, high=99.5, block_rows=1024):
+    """
+    Convert TIFF to PNG out of core, one strip of block_rows rows at a time.
+
+    Images are stretched with a percentile LUT: a first windowed pass builds a
+    global histogram, a second pass maps each strip through the LUT, so one
+    hot pixel cannot wreck the stretch. Masks are binarized strip by strip.
+    Strips go to a temporary GeoTIFF that GDAL then copies line by line to PNG.
+    """
+    tmp_path = f"{os.path.splitext(output_path)[0]}.tmp.tif"
+
+    with warnings.catch_warnings(action="ignore", category=NotGeoreferencedWarning), \
+            rasterio.open(input_path) as src:
+        dtype = np.dtype(src.dtypes[0])
+        print(f"Input: {input_path}, Shape: {(src.height, src.width, src.count)}, Dtype: {dtype}")
+        metrics.count(pixels=src.height * src.width)
+
+        lut, offset = None, 0
+        if not is_mask and dtype != np.uint8:
+            if dtype.kind not in "ui" or dtype.itemsize > 2:
+                raise ValueError(f"Blockwise stretch supports 8/16-bit integer images, got {dtype}")
+            offset = int(np.iinfo(dtype).min)
+            nbins = 1 << (8 * dtype.itemsize)
+
+            # Pass 1: global histogram
+            hist = np.zeros(nbins, dtype=np.int64)
+            for window in _strips(src, block_rows):
+                block = src.read(window=window)
+                if src.nodata is not None:
+                    block = block[block != src.nodata]
+                hist += np.bincount((block.ravel().astype(np.int64) - offset), minlength=nbins)
+            lut = percentile_lut(hist, offset, low, high)
+
+        # Pass 2: map each strip
+        profile = {
+            "driver": "GTiff",
+            "count": src.count,
+            "height": src.height,
+            "width": src.width,
+            "dtype": "uint8",
+            "BIGTIFF": "IF_SAFER",
+        }
+        if src.crs is not None:
+            profile.update(crs=src.crs, transform=src.transform)
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            for window in _strips(src, block_rows):
+                block = src.read(window=window)
+                if is_mask:
+                    # Ensure binary mask (0/255)
+                    block = np.where((block > 0) & (block <= 253), 255, 0).astype(np.uint8)
+                elif lut is not None:
+                    block = lut[block.astype(np.int64) - offset]
+                dst.write(block, window=window)
+
+    try:
+        # PNG cannot hold the georeferencing, so without this GDAL writes it to a stray .png.aux.xml
+        with rasterio.Env(GDAL_PAM_ENABLED="NO"):
+            rasterio.shutil.copy(tmp_path, output_path, driver="PNG")
+    finally:
+        os.remove(tmp_path)
     print(f"Saved: {output_path}")
 
 
@@ -33,11 +122,24 @@ if __name__ == "__main__":
     parser.add_argument("--input", required=True, help="Input .tif file")
     parser.add_argument("--output", required=False, help="Output .png file")
     parser.add_argument("--mask", action="store_true", help="If set, process as mask (binary)")
+    parser.add_argument("--blockwise", action="store_true",
+                        help="Out-of-core two-pass conversion with a percentile stretch (bounded memory)")
+    parser.add_argument("--low", type=float, default=0.5, help="Lower stretch percentile for --blockwise (default: 0.5)")
+    parser.add_argument("--high", type=float, default=99.5, help="Upper stretch percentile for --blockwise (default: 99.5)")
+    parser.add_argument("--block_rows", type=int, default=1024, help="Rows per strip for --blockwise (default: 1024)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "pngconv")
 
     # Auto-generate output name if not provided
     if not args.output:
         args.output = os.path.splitext(args.input)[0] + ".png"
 
-    convert_tif_to_png(args.input, args.output, is_mask=args.mask)
+    if args.blockwise:
+        with metrics.stage("convert_tif_to_png_blockwise"):
+            convert_tif_to_png_blockwise(args.input, args.output, is_mask=args.mask,
+                                         low=args.low, high=args.high, block_rows=args.block_rows)
+    else:
+        with metrics.stage("convert_tif_to_png"):
+            convert_tif_to_png(args.input, args.output, is_mask=args.mask)
 
@@ -9,12 +9,11 @@ import requests
 from PyQt5.QtWidgets import QApplication, QMainWindow, QDockWidget, QVBoxLayout, QCheckBox, QSlider, QWidget, QPushButton, QLabel, QFileDialog
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIcon
-from qgis.core import (
-    QgsApplication, QgsRasterLayer, QgsCoordinateReferenceSystem,
-    QgsProcessingContext, QgsProcessingFeedback, QgsProject
-)
+from qgis.core import QgsApplication, QgsRasterLayer, QgsProject
 from qgis.gui import QgsMapCanvas, QgsMapToolPan, QgsMapToolZoom
-from processing.core.Processing import Processing, processing
+from png2georef import reproject_to_crs
+
+import metrics
 
 
 class MyWnd(QMainWindow):
@@ -109,23 +108,14 @@ class MyWnd(QMainWindow):
         layer.triggerRepaint()
 
 
-def reproject_raster(layer_path, out_path, crs="EPSG:3857"):
-    """Reproject raster to target CRS using GDAL warp via QGIS processing."""
-    layer = QgsRasterLayer(layer_path, layer_path.split("/")[-1])
+def reproject_raster(layer_path, out_path, crs="EPSG:3857", num_threads=4):
+    """Reproject raster to target CRS with rasterio's windowed multi-threaded warp."""
+    name = layer_path.split("/")[-1]
+    reproject_to_crs(layer_path, out_path, crs, num_threads=num_threads)
+    layer = QgsRasterLayer(out_path, f"Reprojected_{name}", "gdal")
     if not layer.isValid():
         raise RuntimeError(f"Raster {layer_path} failed to load!")
-
-    new_crs = QgsCoordinateReferenceSystem(crs)
-    context = QgsProcessingContext()
-    feedback = QgsProcessingFeedback()
-
-    parameters = {
-        'INPUT': layer,
-        'TARGET_CRS': new_crs,
-        'OUTPUT': out_path,
-    }
-    result = processing.run('gdal:warpreproject', parameters, context=context, feedback=feedback)
-    return QgsRasterLayer(result['OUTPUT'], f"Reprojected_{layer.name()}", "gdal")
+    return layer
 
 
 def load_basemap():
@@ -142,17 +132,19 @@ def main():
     parser.add_argument("--p1", required=True, help="Path to past image (TIF)")
     parser.add_argument("--p2", required=True, help="Path to latest image (TIF)")
     parser.add_argument("--res", required=True, help="Path to result/changes raster (TIF)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "qttut")
 
     QgsApplication.setPrefixPath("/usr", True)
     qgs = QgsApplication([], True)
     QgsApplication.initQgis()
-    Processing.initialize()
 
     # Reproject layers
-    p1_layer = reproject_raster(args.p1, "data/proj_p1.tif")
-    p2_layer = reproject_raster(args.p2, "data/proj_p2.tif")
-    res_layer = reproject_raster(args.res, "data/proj_res.tif")
+    with metrics.stage("reproject_layers"):
+        p1_layer = reproject_raster(args.p1, "data/proj_p1.tif")
+        p2_layer = reproject_raster(args.p2, "data/proj_p2.tif")
+        res_layer = reproject_raster(args.res, "data/proj_res.tif")
     base_layer = load_basemap()
 
     # Launch window
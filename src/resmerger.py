@@ -3,8 +3,45 @@ import numpy as np
 import argparse
 import os
 import time
+import rasterio
+from rasterio.windows import Window
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def merge_tiles(input_dir, output_path, rows, cols, tile_size=256, delay=0):
+import metrics
+
+
+def _read_tile(tile_path):
+    tile = cv2.imread(tile_path, cv2.IMREAD_COLOR)
+    if tile is None:
+        raise FileNotFoundError(f"Missing tile: {tile_path}")
+    return tile
+
+
+def iter_tiles(paths, workers=1, prefetch=None):
+    """
+    Yield decoded tiles in order, decoding up to `prefetch` ahead in a thread pool.
+
+    cv2.imread releases the GIL, so PNG decoding overlaps across threads; the
+    bounded queue keeps at most `prefetch` (default 4 * workers) tiles in memory.
+    """
+    if workers <= 1:
+        for path in paths:
+            yield _read_tile(path)
+        return
+
+    prefetch = prefetch or 4 * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(_read_tile, path))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def merge_tiles(input_dir, output_path, rows, cols, tile_size=256, delay=0, workers=1, compression=None):
     """
     Merge tiles into one large image.
     
@@ -15,37 +52,223 @@ def merge_tiles(input_dir, output_path, rows, cols, tile_size=256, delay=0):
         cols (int): Number of tile columns.
         tile_size (int): Size of each square tile (default=256).
         delay (float): Optional delay every 10 rows (default=0 sec).
+        workers (int): Tile decoder threads (default=1).
+        compression (int): PNG compression level 0-9 for the output (default: OpenCV default).
     """
+    t0 = time.perf_counter()
+
     # Preallocate large canvas (single channel, since you only use [:,:,0])
     big_h, big_w = rows * tile_size, cols * tile_size
     merged = np.zeros((big_h, big_w, 1), dtype=np.uint8)
 
+    paths = [os.path.join(input_dir, f"{n}per.png") for n in range(rows * cols)]
+    tiles = iter_tiles(paths, workers)
+
     count = 0
     for i in range(rows):
         if delay > 0 and i % 10 == 0:
             time.sleep(delay)
         for j in range(cols):
-            tile_path = os.path.join(input_dir, f"{count}per.png")
-            tile = cv2.imread(tile_path, cv2.IMREAD_COLOR)
-            if tile is None:
-                raise FileNotFoundError(f"Missing tile: {tile_path}")
+            tile = next(tiles)
             merged[i*tile_size:(i+1)*tile_size,
                    j*tile_size:(j+1)*tile_size, 0] = tile[:, :, 0]
             count += 1
 
-    cv2.imwrite(output_path, merged)
-    print(f"Merged {count} tiles into {output_path}")
+    params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    cv2.imwrite(output_path, merged, params)
+    metrics.count(pixels=count * tile_size * tile_size, tiles=count)
+    elapsed = time.perf_counter() - t0
+    print(f"Merged {count} tiles into {output_path} in {elapsed:.2f}s ({count / elapsed:.1f} tiles/s)")
+
+
+def _geotiff_profile(reference_tif, height, width, compress="deflate"):
+    """Single-band uint8 tiled GeoTIFF profile with the CRS + transform of reference_tif."""
+    with rasterio.open(reference_tif) as ref:
+        crs, transform = ref.crs, ref.transform
+
+    profile = {
+        "driver": "GTiff",
+        "count": 1,
+        "height": height,
+        "width": width,
+        "dtype": "uint8",
+        "crs": crs,
+        "transform": transform,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+    }
+    if compress and compress != "none":
+        profile["compress"] = compress
+    return profile
+
+
+def merge_tiles_geotiff(input_dir, output_tif, rows, cols, reference_tif, tile_size=256, workers=1,
+                        compress="deflate"):
+    """
+    Merge tiles straight into a tiled, compressed GeoTIFF, one tile row at a time.
+
+    Georeferencing (CRS + transform) is copied from reference_tif, so no
+    separate png2georef.py step is needed. Memory is bounded by one
+    tile_size-high band of the mosaic.
+
+    Args:
+        input_dir (str): Directory containing tile images (named sequentially 0per.png, 1per.png, ...).
+        output_tif (str): Path to save merged GeoTIFF.
+        rows (int): Number of tile rows.
+        cols (int): Number of tile columns.
+        reference_tif (str): Reference GeoTIFF with CRS + transform.
+        tile_size (int): Size of each square tile (default=256).
+        workers (int): Tile decoder threads (default=1).
+        compress (str): GeoTIFF compression, e.g. deflate, zstd, lzw or none (default=deflate).
+    """
+    t0 = time.perf_counter()
+    big_h, big_w = rows * tile_size, cols * tile_size
+    profile = _geotiff_profile(reference_tif, big_h, big_w, compress)
+
+    paths = [os.path.join(input_dir, f"{n}per.png") for n in range(rows * cols)]
+    tiles = iter_tiles(paths, workers)
+    band = np.zeros((tile_size, big_w), dtype=np.uint8)
+
+    count = 0
+    with rasterio.open(output_tif, "w", **profile) as dst:
+        for i in range(rows):
+            for j in range(cols):
+                band[:, j*tile_size:(j+1)*tile_size] = next(tiles)[:, :, 0]
+                count += 1
+            dst.write(band, 1, window=Window(0, i * tile_size, big_w, tile_size))
+
+    metrics.count(pixels=count * tile_size * tile_size, tiles=count)
+    elapsed = time.perf_counter() - t0
+    print(f"Merged {count} tiles into {output_tif} in {elapsed:.2f}s ({count / elapsed:.1f} tiles/s)")
+
+
+def feather_window(tile_size):
+    """Separable sine window, strictly positive so every pixel keeps some weight."""
+    w = np.sin(np.pi * (np.arange(tile_size, dtype=np.float32) + 0.5) / tile_size)
+    return np.outer(w, w)[:, :, None]
+
+
+def merge_tiles_blended(input_dirs, output_path, rows, tile_size=256, shifts=None, width=None, cols=None,
+                        workers=1, compression=None, reference_tif=None, compress="deflate"):
+    """
+    Merge overlapping tile predictions with feathered weighted averaging.
+
+    Each input directory holds the predictions of one split.py pass
+    ({count}per.png); its --shift is given in `shifts`. Tiles are accumulated
+    into a running-sum and a weight buffer with a feathered window, one tile
+    row band at a time, and each band is normalized and written into the
+    uint8 mosaic once. All channels are kept in the PNG output; with
+    reference_tif the bands are streamed into a georeferenced single-band
+    GeoTIFF instead, as in merge_tiles_geotiff.
+
+    Args:
+        input_dirs (list): Directories with tile predictions, one per split.py pass.
+        output_path (str): Path to save merged image.
+        rows (int): Number of tile rows.
+        tile_size (int): Size of each square tile (default=256).
+        shifts (list): Horizontal shift used by split.py for each pass (default: all 0).
+        width (int): Width of the split scene in pixels (default: cols * tile_size).
+        cols (int): Number of tile columns, used when width is not given.
+        workers (int): Tile decoder threads per pass (default=1).
+        compression (int): PNG compression level 0-9 for the output (default: OpenCV default).
+        reference_tif (str): Reference GeoTIFF with CRS + transform; writes a GeoTIFF (default: PNG).
+        compress (str): GeoTIFF compression with reference_tif (default=deflate).
+    """
+    t0 = time.perf_counter()
+    shifts = shifts or [0] * len(input_dirs)
+    if len(shifts) != len(input_dirs):
+        raise ValueError("Need one shift per input directory")
+    width = width or cols * tile_size
+
+    weight = feather_window(tile_size)
+    passes = []
+    for input_dir, shift in zip(input_dirs, shifts):
+        # Same column selection as split.py, so {count} maps back to the right place
+        xs = [j * tile_size + shift for j in range(width // tile_size)
+              if 0 <= j * tile_size + shift and (j + 1) * tile_size + shift <= width]
+        paths = [os.path.join(input_dir, f"{n}per.png") for n in range(rows * len(xs))]
+        passes.append((xs, iter_tiles(paths, workers)))
+
+    acc = np.zeros((tile_size, width, 3), dtype=np.float32)
+    wsum = np.zeros((tile_size, width, 1), dtype=np.float32)
+
+    if reference_tif:
+        merged = None
+        dst = rasterio.open(output_path, "w", **_geotiff_profile(reference_tif, rows * tile_size, width, compress))
+    else:
+        merged = np.zeros((rows * tile_size, width, 3), dtype=np.uint8)
+        dst = None
+
+    count = 0
+    try:
+        for i in range(rows):
+            acc.fill(0)
+            wsum.fill(0)
+            for xs, tiles in passes:
+                for x0 in xs:
+                    acc[:, x0:x0+tile_size] += next(tiles) * weight
+                    wsum[:, x0:x0+tile_size] += weight
+                    count += 1
+            np.divide(acc, wsum, out=acc, where=wsum > 0)
+            if dst is not None:
+                dst.write(np.rint(acc[:, :, 0]).astype(np.uint8), 1,
+                          window=Window(0, i * tile_size, width, tile_size))
+            else:
+                merged[i*tile_size:(i+1)*tile_size] = np.rint(acc)
+    finally:
+        if dst is not None:
+            dst.close()
+
+    if merged is not None:
+        params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        cv2.imwrite(output_path, merged, params)
+    metrics.count(pixels=count * tile_size * tile_size, tiles=count)
+    elapsed = time.perf_counter() - t0
+    print(f"Blended {count} tiles from {len(input_dirs)} passes into {output_path} "
+          f"in {elapsed:.2f}s ({count / elapsed:.1f} tiles/s)")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge tiled model outputs into a single large image")
-    parser.add_argument("--input_dir", required=True, help="Directory with tile images (e.g. 0per.png, 1per.png...)")
-    parser.add_argument("--output", required=True, help="Path to save merged image")
+    parser.add_argument("--input_dir", required=True, nargs="+",
+                        help="Directory with tile images (e.g. 0per.png, 1per.png...); several with --blend")
+    parser.add_argument("--output", required=True, help="Path to save merged image (.png, or .tif with --reference)")
     parser.add_argument("--rows", type=int, required=True, help="Number of tile rows")
     parser.add_argument("--cols", type=int, required=True, help="Number of tile columns")
     parser.add_argument("--tile_size", type=int, default=256, help="Tile size (default=256)")
     parser.add_argument("--delay", type=float, default=0, help="Optional delay every 10 rows (sec)")
+    parser.add_argument("--workers", type=int, default=1, help="Tile decoder threads (default=1)")
+    parser.add_argument("--png_compression", type=int, choices=range(10), default=None, metavar="0-9",
+                        help="PNG compression level for the output (default: OpenCV default)")
+    parser.add_argument("--reference", default=None,
+                        help="Reference GeoTIFF; if set, stream the mosaic into a georeferenced GeoTIFF")
+    parser.add_argument("--compress", default="deflate", help="GeoTIFF compression with --reference (default=deflate)")
+    parser.add_argument("--blend", action="store_true",
+                        help="Feather-blend overlapping predictions from one or more split.py passes")
+    parser.add_argument("--shifts", type=int, nargs="+", default=None,
+                        help="split.py --shift of each --input_dir pass, for --blend (default: all 0)")
+    parser.add_argument("--width", type=int, default=None,
+                        help="Width of the split scene in pixels, for --blend (default: cols * tile_size)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "resmerger")
+
+    if not args.blend and len(args.input_dir) > 1:
+        parser.error("several --input_dir values require --blend")
 
-    merge_tiles(args.input_dir, args.output, args.rows, args.cols, args.tile_size, args.delay)
+    if args.blend:
+        with metrics.stage("merge_tiles_blended"):
+            merge_tiles_blended(args.input_dir, args.output, args.rows, args.tile_size, shifts=args.shifts,
+                                width=args.width, cols=args.cols, workers=args.workers,
+                                compression=args.png_compression, reference_tif=args.reference,
+                                compress=args.compress)
+    elif args.reference:
+        with metrics.stage("merge_tiles_geotiff"):
+            merge_tiles_geotiff(args.input_dir[0], args.output, args.rows, args.cols, args.reference,
+                                args.tile_size, workers=args.workers, compress=args.compress)
+    else:
+        with metrics.stage("merge_tiles"):
+            merge_tiles(args.input_dir[0], args.output, args.rows, args.cols, args.tile_size, args.delay,
+                        workers=args.workers, compression=args.png_compression)
 
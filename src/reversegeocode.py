@@ -5,11 +5,18 @@ import cv2
 import torch
 import rasterio
 import csv
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from skimage.measure import find_contours, approximate_polygon
 from skimage.draw import polygon2mask
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 import pyproj
+from scipy.spatial import cKDTree
+from vectorexport import open_vector_writer
+
+import metrics
 
 
 def mask2poly(mask, tolerance=1):
@@ -51,19 +58,259 @@ def extract_polygons(img, area_threshold=900):
     return polygons
 
 
-def geocode_polygons(polygons, ref_tif, transformer, rate_limiter):
-    """Convert polygon pixel coords to lat/lon and reverse geocode."""
-    results = []
+class GeocodeCache:
+    """
+    On-disk (SQLite) cache of reverse geocode results keyed by quantized lat/lon.
+
+    Coordinates are rounded to `precision` decimal places (4 ~ 11 m), so
+    repeated or nearby detections resolve without a network call. Empty
+    results are cached too.
+    """
+
+    def __init__(self, path, precision=4, commit_every=50):
+        self.precision = precision
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            "lat INTEGER, lon INTEGER, raw TEXT, PRIMARY KEY (lat, lon))"
+        )
+
+    def key(self, lat, lon):
+        scale = 10 ** self.precision
+        return round(lat * scale), round(lon * scale)
+
+    def get(self, key):
+        """Return (hit, raw) for a quantized key."""
+        row = self.conn.execute("SELECT raw FROM geocode WHERE lat = ? AND lon = ?", key).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def put(self, key, raw):
+        """Store one result, committing every `commit_every` puts so an aborted run keeps its lookups."""
+        self.conn.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)", (*key, json.dumps(raw)))
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def reverse_lookup(points, rate_limiter, cache=None, concurrency=1):
+    """
+    Reverse geocode (lat, lon) points, returning one raw result (or None) per point.
+
+    Points already in the cache, or quantizing to the same key as another
+    point, are looked up only once. With concurrency > 1 the remaining
+    lookups run in a bounded thread pool; the RateLimiter still enforces
+    its minimum delay between calls, so only raise concurrency for backends
+    that allow it.
+
+    Each result is cached as soon as it arrives. A lookup that raises
+    (timeout, HTTP error) is logged and returned as None without being
+    cached, so a re-run only retries the failed points.
+    """
+    def lookup(point):
+        location = rate_limiter(point, language="en")
+        return location.raw if location else None
+
+    keys = [cache.key(*p) if cache else p for p in points]
+    resolved, pending = {}, {}
+    for key, point in zip(keys, points):
+        if key in resolved or key in pending:
+            continue
+        hit, raw = cache.get(key) if cache else (False, None)
+        if hit:
+            resolved[key] = raw
+        else:
+            pending[key] = point
+
+    print(f"Geocoding {len(points)} points: {len(resolved)} cached, {len(pending)} to look up")
+
+    failed = 0
+
+    def store(key, call):
+        nonlocal failed
+        try:
+            raw = call()
+        except Exception as e:
+            logging.warning(f"Reverse geocode failed for {pending[key]}: {e}")
+            failed += 1
+            resolved[key] = None
+            return
+        resolved[key] = raw
+        if cache:
+            cache.put(key, raw)
+
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {pool.submit(lookup, point): key for key, point in pending.items()}
+            for future in as_completed(futures):
+                store(futures[future], future.result)
+    else:
+        for key, point in pending.items():
+            store(key, lambda: lookup(point))
+
+    if failed:
+        print(f"⚠️ {failed} of {len(pending)} lookups failed; they are not cached and will be retried next run")
+
+    return [resolved[key] for key in keys]
+
+
+def _unit_vectors(lat, lon):
+    """Lat/lon in degrees -> points on the unit sphere, so chord distance tracks great-circle distance."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+class OfflineGeocoder:
+    """
+    Offline reverse geocoder backed by a local gazetteer and a KD-tree.
+
+    The gazetteer is a CSV (or tab-separated .tsv/.txt) file with a header
+    row containing lat/lon (or latitude/longitude) columns; every other
+    column (name, admin area, ...) is returned as an attribute of the
+    nearest place. The tree is built once and all points are answered in
+    a single batched query.
+    """
+
+    EARTH_RADIUS_KM = 6371.0088
+
+    def __init__(self, path, max_distance_km=None):
+        delimiter = "\t" if path.endswith((".tsv", ".txt")) else ","
+        with open(path, newline="", encoding="utf-8") as f:
+            self.places = list(csv.DictReader(f, delimiter=delimiter))
+        if not self.places:
+            raise ValueError(f"Gazetteer {path} is empty")
+
+        fields = self.places[0].keys()
+        self.lat_key = "lat" if "lat" in fields else "latitude"
+        self.lon_key = "lon" if "lon" in fields else "longitude"
+        if self.lat_key not in fields or self.lon_key not in fields:
+            raise ValueError(f"Gazetteer {path} needs lat/lon (or latitude/longitude) columns")
+
+        lat = np.array([float(p[self.lat_key]) for p in self.places])
+        lon = np.array([float(p[self.lon_key]) for p in self.places])
+        self.tree = cKDTree(_unit_vectors(lat, lon))
+        self.max_distance_km = max_distance_km
+        print(f"Loaded gazetteer {path} with {len(self.places)} places")
+
+    def reverse_batch(self, points):
+        """Return the nearest place (raw dict with distance_km) for each (lat, lon), or None beyond max distance."""
+        if not points:
+            return []
+        lat, lon = np.asarray(points, dtype=np.float64).T
+        chord, idx = self.tree.query(_unit_vectors(lat, lon))
+        dist_km = 2 * self.EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+        results = []
+        for i, d in zip(idx, dist_km):
+            if self.max_distance_km is not None and d > self.max_distance_km:
+                results.append(None)
+            else:
+                results.append({**self.places[i], "distance_km": round(float(d), 3)})
+        return results
+
+
+def georeference_polygons(polygons, transform, transformer):
+    """
+    Georeference every vertex of every polygon in one batched transform.
+
+    All vertices are concatenated into NumPy arrays, mapped through the
+    raster affine transform (pixel centers, like rasterio's xy) and the
+    pyproj transformer once, then split back per polygon. Centroids and
+    areas are computed with the shoelace formula in the map CRS.
+
+    Args:
+        polygons: List of polygons as [[col, row], ...] pixel vertices.
+        transform: Affine transform of the reference raster.
+        transformer: pyproj Transformer from the raster CRS (always_xy=True).
+
+    Returns:
+        (rings, centroids, areas): a list of (N, 2) arrays of transformed
+        (x, y) = (lon, lat) vertices, an (n, 2) array of transformed
+        centroids, and an (n,) array of areas in squared map units.
+    """
+    if not polygons:
+        return [], np.empty((0, 2)), np.empty(0)
+
+    lengths = np.array([len(p) for p in polygons])
+    verts = np.concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polygons])
+    cols, rows = verts[:, 0] + 0.5, verts[:, 1] + 0.5
+    xs = transform.a * cols + transform.b * rows + transform.c
+    ys = transform.d * cols + transform.e * rows + transform.f
+
+    # Shoelace over each closed ring of the concatenated arrays
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    nxt = np.arange(len(xs)) + 1
+    nxt[ends - 1] = starts
+    cross = xs * ys[nxt] - xs[nxt] * ys
+    poly_id = np.repeat(np.arange(len(polygons)), lengths)
+
+    a2 = np.bincount(poly_id, cross)
+    degenerate = np.abs(a2) < 1e-12
+    safe = np.where(degenerate, 1.0, 3 * a2)
+    cx = np.where(degenerate, np.bincount(poly_id, xs) / lengths, np.bincount(poly_id, (xs + xs[nxt]) * cross) / safe)
+    cy = np.where(degenerate, np.bincount(poly_id, ys) / lengths, np.bincount(poly_id, (ys + ys[nxt]) * cross) / safe)
+    areas = np.abs(a2) / 2
+
+    tx, ty = transformer.transform(np.concatenate([xs, cx]), np.concatenate([ys, cy]))
+    tx, ty = np.asarray(tx), np.asarray(ty)
+    n = len(xs)
+    rings = np.split(np.column_stack([tx[:n], ty[:n]]), ends[:-1])
+    centroids = np.column_stack([tx[n:], ty[n:]])
+    return rings, centroids, areas
+
+
+def geocode_centroids(centroids, rate_limiter=None, cache=None, concurrency=1, gazetteer=None):
+    """
+    Reverse geocode (lon, lat) centroids, returning one raw result (or None) per centroid.
+
+    Uses the offline gazetteer (one batched KD-tree query) if given,
+    otherwise the rate limited online geocoder.
+    """
+    points = [(lat, lon) for lon, lat in np.asarray(centroids).tolist()]
+    if gazetteer is not None:
+        return gazetteer.reverse_batch(points)
+    return reverse_lookup(points, rate_limiter, cache, concurrency)
+
+
+def geocode_polygons(polygons, ref_tif, transformer, rate_limiter=None, cache=None, concurrency=1,
+                     gazetteer=None):
+    """Convert polygon pixel coords to lat/lon and reverse geocode each polygon centroid."""
     with rasterio.open(ref_tif) as map_layer:
-        for poly in polygons:
-            # Take first vertex as representative point
-            px, py = poly[0]
-            x, y = map_layer.xy(py, px)  # Note: rasterio expects (row, col)
-            lon, lat = transformer.transform(x, y)
-            location = rate_limiter((lat, lon), language="en")
-            if location:
-                results.append(location.raw)
-    return results
+        _, centroids, _ = georeference_polygons(polygons, map_layer.transform, transformer)
+    raws = geocode_centroids(centroids, rate_limiter, cache, concurrency, gazetteer)
+    return [raw for raw in raws if raw]
+
+
+def export_polygons(output_path, rings, centroids, areas, epsg=4326, geocodes=None):
+    """Stream georeferenced polygons with area, centroid and optional geocode attributes to a vector file."""
+    writer = open_vector_writer(output_path, int(epsg))
+    try:
+        for k, ring in enumerate(rings):
+            if len(ring) < 3:
+                continue  # not a polygon
+            properties = {
+                "area": float(areas[k]),
+                "centroid_x": float(centroids[k][0]),
+                "centroid_y": float(centroids[k][1]),
+            }
+            if geocodes is not None and geocodes[k]:
+                properties.update({f"geo_{key}": value for key, value in geocodes[k].items()})
+            writer.write(ring, properties)
+    finally:
+        writer.close()
+    print(f"✅ Vector file saved: {output_path} ({writer.count} features)")
 
 
 def save_to_csv(data_list, output_csv):
@@ -71,9 +318,10 @@ def save_to_csv(data_list, output_csv):
     if not data_list:
         print("⚠️ No data to save.")
         return
-    header = data_list[0].keys()
+    # Union of keys in first-seen order; rows may carry different fields
+    header = list(dict.fromkeys(key for data in data_list for key in data))
     with open(output_csv, "w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=header)
+        writer = csv.DictWriter(csvfile, fieldnames=header, restval="")
         writer.writeheader()
         for data in data_list:
             writer.writerow(data)
@@ -88,26 +336,70 @@ def main():
     parser.add_argument("--epsg_in", default="32643", help="Input projection EPSG (default: 32643)")
     parser.add_argument("--epsg_out", default="4326", help="Output projection EPSG (default: 4326)")
     parser.add_argument("--area", type=int, default=900, help="Minimum area threshold for polygons")
+    parser.add_argument("--cache", default=None, help="SQLite geocode cache file (default: no cache)")
+    parser.add_argument("--cache_precision", type=int, default=4,
+                        help="Decimal places of lat/lon used as cache key (default: 4, ~11 m)")
+    parser.add_argument("--geocoder_domain", default=None,
+                        help="Nominatim-compatible server, e.g. localhost:8080 (default: public Nominatim)")
+    parser.add_argument("--geocoder_scheme", default="https", help="Geocoder URL scheme (default: https)")
+    parser.add_argument("--min_delay", type=float, default=1,
+                        help="Minimum seconds between geocoder calls (default: 1, Nominatim usage policy)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Concurrent geocoder lookups, for backends that allow it (default: 1)")
+    parser.add_argument("--gazetteer", default=None,
+                        help="Offline gazetteer CSV with lat/lon columns; replaces the online geocoder")
+    parser.add_argument("--max_distance_km", type=float, default=None,
+                        help="Drop gazetteer matches farther than this (default: no limit)")
+    parser.add_argument("--vector", default=None,
+                        help="Also export polygons with area/centroid/geocode attributes (.gpkg or .geojson)")
+    parser.add_argument("--skip_geocode", action="store_true",
+                        help="Do not reverse geocode (only useful with --vector)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "reversegeocode")
 
     # Load image (grayscale if RGB)
     img = cv2.imread(args.input, cv2.IMREAD_GRAYSCALE)
     print(f"Loaded image {args.input}, shape={img.shape}")
 
     # Extract polygons
-    polygons = extract_polygons(img, args.area)
+    with metrics.stage("extract_polygons", pixels=img.size):
+        polygons = extract_polygons(img, args.area)
     print(f"Found {len(polygons)} polygons above threshold {args.area}")
 
     # Setup geocoder + transformer
-    geolocator = Nominatim(user_agent="binary_change_detector")
-    rate_limiter = RateLimiter(geolocator.reverse, min_delay_seconds=1)
-    transformer = pyproj.Transformer.from_crs(f"epsg:{args.epsg_in}", f"epsg:{args.epsg_out}")
+    transformer = pyproj.Transformer.from_crs(f"epsg:{args.epsg_in}", f"epsg:{args.epsg_out}", always_xy=True)
+    with metrics.stage("georeference_polygons", tiles=len(polygons)), rasterio.open(args.reference) as map_layer:
+        rings, centroids, areas = georeference_polygons(polygons, map_layer.transform, transformer)
+
+    geocodes = None
+    if not args.skip_geocode:
+        gazetteer, rate_limiter, cache = None, None, None
+        if args.gazetteer:
+            gazetteer = OfflineGeocoder(args.gazetteer, args.max_distance_km)
+        else:
+            geocoder_kwargs = {"domain": args.geocoder_domain, "scheme": args.geocoder_scheme} if args.geocoder_domain else {}
+            geolocator = Nominatim(user_agent="binary_change_detector", **geocoder_kwargs)
+            # Raise after the retries so failures are not cached as empty results
+            rate_limiter = RateLimiter(geolocator.reverse, min_delay_seconds=args.min_delay,
+                                       swallow_exceptions=False)
+            cache = GeocodeCache(args.cache, args.cache_precision) if args.cache else None
+
+        # Geocode polygons
+        try:
+            with metrics.stage("geocode_centroids", tiles=len(centroids)):
+                geocodes = geocode_centroids(centroids, rate_limiter, cache=cache,
+                                             concurrency=args.concurrency, gazetteer=gazetteer)
+        finally:
+            if cache:
+                cache.close()
 
-    # Geocode polygons
-    data_list = geocode_polygons(polygons, args.reference, transformer, rate_limiter)
+        # Save results
+        save_to_csv([raw for raw in geocodes if raw], args.output)
 
-    # Save results
-    save_to_csv(data_list, args.output)
+    if args.vector:
+        with metrics.stage("export_polygons", tiles=len(rings)):
+            export_polygons(args.vector, rings, centroids, areas, args.epsg_out, geocodes)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,174 @@
 import cv2
 import os
 import argparse
+import json
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
 
+import metrics
 
-def split_images(before_path, after_path, label_path, output_dir, patch_size=256, shift=0):
+SUBSETS = ("A", "B", "label")
+
+
+class PngPatchWriter:
+    """
+    Write each patch as its own image file: {output_dir}/{A,B,label}/w{count}.png.
+
+    With workers > 1 PNG encoding runs in a thread pool (cv2.imwrite releases
+    the GIL); at most 4 * workers patches are queued at any time. close()
+    writes an index.json with the patch count and the metadata it is given
+    (patch origins, and the scene CRS and transform when georeferenced).
+    """
+
+    def __init__(self, output_dir, workers=1, compression=None):
+        self.output_dir = output_dir
+        self.params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._slots = threading.BoundedSemaphore(4 * workers)
+        self._error = None
+        self._count = 0
+        for sub in SUBSETS:
+            os.makedirs(os.path.join(output_dir, sub), exist_ok=True)
+
+    def _imwrite(self, path, patch):
+        if not cv2.imwrite(path, patch, self.params):
+            raise IOError(f"Could not write {path}")
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def write(self, sub, count, patch):
+        path = os.path.join(self.output_dir, sub, f"w{count}.png")
+        self._count = max(self._count, count + 1)
+        if self._pool is None:
+            self._imwrite(path, patch)
+            return
+        if self._error is not None:
+            raise self._error
+        self._slots.acquire()
+        self._pool.submit(self._imwrite, path, patch).add_done_callback(self._done)
+
+    def close(self, **meta):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        if self._error is not None:
+            raise self._error
+        with open(os.path.join(self.output_dir, "index.json"), "w") as f:
+            json.dump({"format": "png", "count": self._count, **meta}, f)
+
+
+class ShardPatchWriter:
+    """
+    Pack patches into fixed-size .npy shards with a JSON offset index.
+
+    Patch i of a subset lives in shard i // shard_size at byte
+    offset + (i % shard_size) * patch_nbytes, so it can be read back with a
+    single seek (see ShardReader). Patches must be written in count order.
+    """
+
+    def __init__(self, output_dir, total, shard_size=4096):
+        self.output_dir = output_dir
+        self.total = total
+        self.shard_size = shard_size
+        self.subsets = {}
+        self._open = {}
+        for sub in SUBSETS:
+            os.makedirs(os.path.join(output_dir, sub), exist_ok=True)
+
+    def write(self, sub, count, patch):
+        shard, pos = divmod(count, self.shard_size)
+        current = self._open.get(sub)
+        if current is None or current[0] != shard:
+            if current is not None:
+                current[1].flush()
+            meta = self.subsets.setdefault(sub, {
+                "dtype": patch.dtype.str,
+                "shape": list(patch.shape),
+                "shards": [],
+            })
+            n = min(self.shard_size, self.total - shard * self.shard_size)
+            rel = os.path.join(sub, f"shard-{shard:05d}.npy")
+            mm = np.lib.format.open_memmap(os.path.join(self.output_dir, rel), mode="w+",
+                                           dtype=patch.dtype, shape=(n,) + patch.shape)
+            meta["shards"].append({"file": rel, "offset": mm.offset, "count": n})
+            self._open[sub] = current = (shard, mm)
+        current[1][pos] = patch
+
+    def close(self, **meta):
+        for _, mm in self._open.values():
+            mm.flush()
+        self._open.clear()
+        index = {
+            "format": "npy-shards",
+            "count": self.total,
+            "shard_size": self.shard_size,
+            "subsets": self.subsets,
+            **meta,
+        }
+        with open(os.path.join(self.output_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+
+
+class ShardReader:
+    """Random access to patches written by ShardPatchWriter; patches are zero-copy memmap views."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        with open(os.path.join(output_dir, "index.json")) as f:
+            self.index = json.load(f)
+        self.shard_size = self.index["shard_size"]
+        self._maps = {}
+
+    def __len__(self):
+        return self.index["count"]
+
+    def get(self, i, sub="A"):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        shard, pos = divmod(i, self.shard_size)
+        key = (sub, shard)
+        if key not in self._maps:
+            rel = self.index["subsets"][sub]["shards"][shard]["file"]
+            self._maps[key] = np.load(os.path.join(self.output_dir, rel), mmap_mode="r")
+        return self._maps[key][pos]
+
+    def __getitem__(self, i):
+        return tuple(self.get(i, sub) for sub in SUBSETS)
+
+
+def read_index(output_dir):
+    """The index.json of a split output directory, or None for directories without one."""
+    path = os.path.join(output_dir, "index.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def patch_transform(index, i):
+    """Affine geotransform of patch i from a split index, or None if the scene was not georeferenced."""
+    if not index.get("transform"):
+        return None
+    x0, y0 = index["origins"][i]
+    return rasterio.Affine(*index["transform"]) * rasterio.Affine.translation(x0, y0)
+
+
+def _open_writer(fmt, output_dir, total, shard_size, workers=1, compression=None):
+    if fmt == "npy":
+        return ShardPatchWriter(output_dir, total, shard_size)
+    return PngPatchWriter(output_dir, workers=workers, compression=compression)
+
+
+def split_images(before_path, after_path, label_path, output_dir, patch_size=256, shift=0,
+                 fmt="png", shard_size=4096, workers=1, compression=None):
     """
     Split large images into smaller patches.
 
@@ -14,7 +179,13 @@ def split_images(before_path, after_path, label_path, output_dir, patch_size=256
         output_dir (str): Output directory where subfolders A, B, label will be created.
         patch_size (int): Patch size (default=256).
         shift (int): Optional horizontal shift for overlapped crops (default=0).
+        fmt (str): "png" for one file per patch, "npy" for sharded containers (default="png").
+        shard_size (int): Patches per shard when fmt="npy" (default=4096).
+        workers (int): PNG encoder threads (default=1).
+        compression (int): PNG compression level 0-9 (default: OpenCV default).
     """
+    t0 = time.perf_counter()
+
     # Read images
     before = cv2.imread(before_path, cv2.IMREAD_COLOR)
     after = cv2.imread(after_path, cv2.IMREAD_COLOR)
@@ -25,34 +196,119 @@ def split_images(before_path, after_path, label_path, output_dir, patch_size=256
 
     print(f"Input shapes -> before: {before.shape}, after: {after.shape}, label: {label.shape}")
 
-    # Create output dirs
-    for sub in ["A", "B", "label"]:
-        os.makedirs(os.path.join(output_dir, sub), exist_ok=True)
-
     h, w = before.shape[:2]
     hr, wr = h // patch_size, w // patch_size
 
     print(f"Splitting into {hr} x {wr} patches -> Total = {hr * wr}")
 
+    cols = [j for j in range(wr) if (j + 1) * patch_size + shift <= w]  # skip incomplete tiles
+    writer = _open_writer(fmt, output_dir, hr * len(cols), shard_size, workers, compression)
+
     count = 0
+    origins = []
     for i in range(hr):
-        for j in range(wr):
+        for j in cols:
             x0, y0 = j * patch_size + shift, i * patch_size
             x1, y1 = x0 + patch_size, y0 + patch_size
 
-            if x1 > w or y1 > h:
-                continue  # skip incomplete tiles
-
             n1 = before[y0:y1, x0:x1]
             n2 = after[y0:y1, x0:x1]
             n3 = label[y0:y1, x0:x1]
 
-            cv2.imwrite(os.path.join(output_dir, "A", f"w{count}.png"), n1)
-            cv2.imwrite(os.path.join(output_dir, "B", f"w{count}.png"), n2)
-            cv2.imwrite(os.path.join(output_dir, "label", f"w{count}.png"), n3)
+            writer.write("A", count, n1)
+            writer.write("B", count, n2)
+            writer.write("label", count, n3)
+            origins.append([x0, y0])
             count += 1
 
-    print(f"Done! Saved {count} patches to {output_dir}")
+    writer.close(patch_size=patch_size, origins=origins)
+    metrics.count(pixels=count * patch_size * patch_size, tiles=count)
+    elapsed = time.perf_counter() - t0
+    print(f"Done! Saved {count} patches to {output_dir} in {elapsed:.2f}s ({count / elapsed:.1f} patches/s)")
+
+
+def _to_cv2(arr, color):
+    """
+    Convert a rasterio (bands, h, w) array to the layout cv2.imread would
+    return: 3-channel uint8 BGR with color (IMREAD_COLOR), unchanged otherwise.
+    """
+    if color and arr.dtype == np.uint16:
+        arr = (arr >> 8).astype(np.uint8)  # as IMREAD_COLOR does for 16-bit files
+    if arr.shape[0] == 1:
+        img = arr[0]
+        return cv2.merge([img, img, img]) if color else img
+    img = np.moveaxis(arr, 0, -1)
+    # rasterio yields RGB(A), cv2 expects BGR(A)
+    img = np.concatenate([img[..., 2::-1], img[..., 3:]], axis=-1)
+    return img[..., :3] if color else img
+
+
+def split_images_streaming(before_path, after_path, label_path, output_dir, patch_size=256, shift=0,
+                           fmt="png", shard_size=4096, workers=1, compression=None):
+    """
+    Split large images into smaller patches, reading one row-strip of tiles at a time.
+
+    Same patch layout and numbering as split_images, but peak memory is bounded
+    by one patch_size-high strip of each input instead of the full scenes.
+    For georeferenced inputs the scene CRS and transform are recorded in
+    index.json next to the patch origins, so each patch's geotransform can be
+    recovered with patch_transform.
+
+    Args:
+        before_path (str): Path to "before" image.
+        after_path (str): Path to "after" image.
+        label_path (str): Path to label/mask image.
+        output_dir (str): Output directory where subfolders A, B, label will be created.
+        patch_size (int): Patch size (default=256).
+        shift (int): Optional horizontal shift for overlapped crops (default=0).
+        fmt (str): "png" for one file per patch, "npy" for sharded containers (default="png").
+        shard_size (int): Patches per shard when fmt="npy" (default=4096).
+        workers (int): PNG encoder threads (default=1).
+        compression (int): PNG compression level 0-9 (default: OpenCV default).
+    """
+    t0 = time.perf_counter()
+
+    with warnings.catch_warnings(action="ignore", category=NotGeoreferencedWarning), \
+            rasterio.open(before_path) as before, \
+            rasterio.open(after_path) as after, \
+            rasterio.open(label_path) as label:
+        print(f"Input shapes -> before: {before.shape}, after: {after.shape}, label: {label.shape}")
+
+        h, w = before.height, before.width
+        hr, wr = h // patch_size, w // patch_size
+        georef = before.crs is not None
+
+        print(f"Splitting into {hr} x {wr} patches -> Total = {hr * wr}")
+
+        # Columns whose patch lies fully inside the image
+        cols = [j for j in range(wr) if 0 <= j * patch_size + shift and (j + 1) * patch_size + shift <= w]
+        writer = _open_writer(fmt, output_dir, hr * len(cols), shard_size, workers, compression)
+
+        count = 0
+        origins = []
+        strip_x0 = cols[0] * patch_size + shift if cols else 0
+        strip_w = len(cols) * patch_size
+
+        for i in range(hr if cols else 0):
+            y0 = i * patch_size
+            strip_window = Window(strip_x0, y0, strip_w, patch_size)
+            strips = [src.read(window=strip_window) for src in (before, after, label)]
+
+            for k in range(len(cols)):
+                xs = k * patch_size
+                patches = [strip[:, :, xs:xs + patch_size] for strip in strips]
+                for sub, patch, color in zip(SUBSETS, patches, (True, True, False)):
+                    writer.write(sub, count, _to_cv2(patch, color))
+                origins.append([strip_x0 + xs, y0])
+                count += 1
+
+        writer.close(patch_size=patch_size, origins=origins,
+                     crs=before.crs.to_string() if georef else None,
+                     transform=list(before.transform)[:6] if georef else None)
+
+    metrics.count(pixels=count * patch_size * patch_size, tiles=count)
+    elapsed = time.perf_counter() - t0
+    print(f"Done! Saved {count} patches to {output_dir} in {elapsed:.2f}s ({count / elapsed:.1f} patches/s)")
 
 
 if __name__ == "__main__":
@@ -63,7 +319,23 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", required=True, help="Output directory to save patches")
     parser.add_argument("--patch_size", type=int, default=256, help="Patch size (default=256)")
     parser.add_argument("--shift", type=int, default=0, help="Optional horizontal shift (default=0)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read one row-strip of patches at a time (bounded memory, records GeoTIFF "
+                             "georeferencing in index.json)")
+    parser.add_argument("--format", choices=["png", "npy"], default="png",
+                        help="Output format: one image file per patch, or sharded .npy containers "
+                             "with an index.json (default: png)")
+    parser.add_argument("--shard_size", type=int, default=4096, help="Patches per shard for --format npy")
+    parser.add_argument("--workers", type=int, default=1, help="PNG encoder threads (default=1)")
+    parser.add_argument("--png_compression", type=int, choices=range(10), default=None, metavar="0-9",
+                        help="PNG compression level, lower is faster and larger (default: OpenCV default)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, "split")
 
-    split_images(args.before, args.after, args.label, args.output_dir, args.patch_size, args.shift)
+    split = split_images_streaming if args.stream else split_images
+    with metrics.stage(split.__name__):
+        split(args.before, args.after, args.label, args.output_dir, args.patch_size, args.shift,
+              fmt=args.format, shard_size=args.shard_size,
+              workers=args.workers, compression=args.png_compression)
 
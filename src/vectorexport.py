@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+import struct
+
+import pyproj
+
+
+def _closed(ring):
+    """Return ring as a list of (x, y) tuples with the first vertex repeated at the end."""
+    ring = [(float(x), float(y)) for x, y in ring]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return ring
+
+
+def _bounds(ring):
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def _plain(value):
+    """Flatten attribute values to types a vector attribute table can hold."""
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value)
+
+
+class GeoJSONWriter:
+    """Stream polygon features into a GeoJSON FeatureCollection, one feature at a time."""
+
+    def __init__(self, path, epsg=4326):
+        self.f = open(path, "w")
+        self.f.write('{"type": "FeatureCollection",\n')
+        if epsg != 4326:
+            self.f.write(f'"crs": {{"type": "name", "properties": {{"name": "urn:ogc:def:crs:EPSG::{epsg}"}}}},\n')
+        self.f.write('"features": [\n')
+        self.count = 0
+
+    def write(self, ring, properties):
+        ring = _closed(ring)
+        minx, maxx, miny, maxy = _bounds(ring)
+        feature = {
+            "type": "Feature",
+            "id": self.count + 1,
+            "bbox": [minx, miny, maxx, maxy],
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {k: _plain(v) for k, v in properties.items()},
+        }
+        if self.count:
+            self.f.write(",\n")
+        self.f.write(json.dumps(feature))
+        self.count += 1
+
+    def close(self):
+        self.f.write("\n]}\n")
+        self.f.close()
+
+
+class GeoPackageWriter:
+    """
+    Stream polygon features into an OGC GeoPackage with an R-tree spatial index.
+
+    Written with the standard library sqlite3 module, so no GDAL/OGR Python
+    bindings are needed. Attribute columns are added as new keys appear.
+    """
+
+    def __init__(self, path, epsg=4326, table="changes"):
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        self.table = table
+        self.srs_id = int(epsg)
+        self.columns = set()
+        self.count = 0
+        self.extent = [float("inf"), float("inf"), float("-inf"), float("-inf")]
+
+        crs = pyproj.CRS.from_epsg(self.srs_id)
+        c = self.conn
+        c.execute("PRAGMA application_id = 1196444487")  # 'GPKG'
+        c.execute("PRAGMA user_version = 10400")
+        c.executescript("""
+            CREATE TABLE gpkg_spatial_ref_sys (
+                srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+                organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+            CREATE TABLE gpkg_contents (
+                table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+                description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER);
+            CREATE TABLE gpkg_geometry_columns (
+                table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+                srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+                PRIMARY KEY (table_name, column_name));
+            CREATE TABLE gpkg_extensions (
+                table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+                definition TEXT NOT NULL, scope TEXT NOT NULL);
+        """)
+        c.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            (crs.name, self.srs_id, "EPSG", self.srs_id, crs.to_wkt("WKT1_GDAL"), None),
+        ])
+        c.execute(f'CREATE TABLE "{table}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom POLYGON)')
+        c.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)",
+                  (table, table, self.srs_id))
+        c.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'POLYGON', ?, 0, 0)", (table, self.srs_id))
+        c.execute(f'CREATE VIRTUAL TABLE "rtree_{table}_geom" USING rtree(id, minx, maxx, miny, maxy)')
+        c.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', "
+                  "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')", (table,))
+
+    def _geometry(self, ring, bounds):
+        # GeoPackage binary header (little endian, XY envelope) + WKB polygon
+        header = b"GP" + struct.pack("<BBi4d", 0, 0b011, self.srs_id, *bounds)
+        wkb = struct.pack("<BIII", 1, 3, 1, len(ring)) + b"".join(struct.pack("<2d", *p) for p in ring)
+        return header + wkb
+
+    def write(self, ring, properties):
+        ring = _closed(ring)
+        bounds = _bounds(ring)
+        properties = {k: _plain(v) for k, v in properties.items()}
+
+        for key, value in properties.items():
+            if key not in self.columns:
+                kind = "REAL" if isinstance(value, float) else "INTEGER" if isinstance(value, int) else "TEXT"
+                self.conn.execute(f'ALTER TABLE "{self.table}" ADD COLUMN "{key}" {kind}')
+                self.columns.add(key)
+
+        names = ", ".join(f'"{k}"' for k in properties)
+        marks = ", ".join("?" for _ in properties)
+        cur = self.conn.execute(
+            f'INSERT INTO "{self.table}" (geom{", " if properties else ""}{names}) VALUES (?{", " if properties else ""}{marks})',
+            (self._geometry(ring, bounds), *properties.values()))
+        self.conn.execute(f'INSERT INTO "rtree_{self.table}_geom" VALUES (?, ?, ?, ?, ?)', (cur.lastrowid, *bounds))
+
+        minx, maxx, miny, maxy = bounds
+        e = self.extent
+        self.extent = [min(e[0], minx), min(e[1], miny), max(e[2], maxx), max(e[3], maxy)]
+        self.count += 1
+
+    def close(self):
+        if self.count:
+            self.conn.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?",
+                              (*self.extent, self.table))
+        self.conn.commit()
+        self.conn.close()
+
+
+def open_vector_writer(path, epsg=4326):
+    """Pick a streaming vector writer from the file extension (.gpkg, .geojson/.json)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".gpkg":
+        return GeoPackageWriter(path, epsg)
+    if ext in (".geojson", ".json"):
+        return GeoJSONWriter(path, epsg)
+    raise ValueError(f"Unsupported vector format '{ext}' (use .gpkg or .geojson)")